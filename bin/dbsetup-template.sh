@@ -555,6 +555,88 @@ CREATE INDEX "_subject last tagged txid_tsv_idx" ON "_subject last tagged txid"
 
 EOF
 
+# add per-catalog version counters bumped by writes to tagdef and view subjects
+# so the service can validate its tagdef and view caches with one key lookup,
+# plus a 'tags' counter bumped by every tag modification to validate ETags;
+# counters rather than txids so late commits of older transactions still advance them
+cat >&${COPROC[1]} <<EOF
+CREATE TABLE "cache versions" ( idtag text PRIMARY KEY, txid int8 NOT NULL );
+
+INSERT INTO "cache versions" (idtag, txid) VALUES ('tagdef', txid_current());
+INSERT INTO "cache versions" (idtag, txid) VALUES ('view', txid_current());
+INSERT INTO "cache versions" (idtag, txid) VALUES ('tags', 0);
+
+CREATE FUNCTION "cache versions subject bump"() RETURNS trigger AS \$\$
+BEGIN
+  UPDATE "cache versions" SET txid = txid + 1
+    WHERE idtag IN (SELECT value FROM "_tags present" WHERE subject = NEW.subject) ;
+  RETURN NULL;
+END;
+\$\$ LANGUAGE plpgsql;
+
+CREATE FUNCTION "cache versions tag bump"() RETURNS trigger AS \$\$
+BEGIN
+  UPDATE "cache versions" SET txid = txid + 1
+    WHERE idtag IN (SELECT value FROM "_tagdef" WHERE subject = NEW.subject) ;
+  UPDATE "cache versions" SET txid = txid + 1 WHERE idtag = 'tags' ;
+  RETURN NULL;
+END;
+\$\$ LANGUAGE plpgsql;
+
+CREATE TRIGGER "cache versions subject bump" AFTER INSERT OR UPDATE ON "_subject last tagged txid"
+  FOR EACH ROW EXECUTE PROCEDURE "cache versions subject bump"();
+
+CREATE TRIGGER "cache versions tag bump" AFTER INSERT OR UPDATE ON "_tag last modified txid"
+  FOR EACH ROW EXECUTE PROCEDURE "cache versions tag bump"();
+
+EOF
+
+# add per-role visibility index maintained from owner, read users, and write users
+# so read authz and readok/writeok become one indexed semi-join on (role, subject)
+cat >&${COPROC[1]} <<EOF
+CREATE TABLE "subject role access" ( role text NOT NULL,
+                                     subject bigint NOT NULL REFERENCES resources (subject) ON DELETE CASCADE,
+                                     readok boolean NOT NULL, writeok boolean NOT NULL, isowner boolean NOT NULL,
+                                     PRIMARY KEY (role, subject) );
+CREATE INDEX "subject role access_subject_idx" ON "subject role access" (subject) ;
+
+CREATE FUNCTION "subject role access refresh"(bigint) RETURNS void AS \$\$
+  DELETE FROM "subject role access" WHERE subject = \$1 ;
+  -- the EXISTS test skips subjects whose resource is being deleted by cascade
+  INSERT INTO "subject role access" (role, subject, readok, writeok, isowner)
+    SELECT role, \$1, bool_or(readok), bool_or(writeok), bool_or(isowner)
+    FROM (SELECT value AS role, True AS readok, True AS writeok, True AS isowner FROM "_owner" WHERE subject = \$1
+          UNION ALL SELECT value, True, False, False FROM "_read users" WHERE subject = \$1
+          UNION ALL SELECT value, False, True, False FROM "_write users" WHERE subject = \$1) s
+    WHERE EXISTS (SELECT 1 FROM resources WHERE subject = \$1)
+    GROUP BY role ;
+\$\$ LANGUAGE SQL;
+
+CREATE FUNCTION "subject role access update"() RETURNS trigger AS \$\$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM "subject role access refresh"(OLD.subject) ;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM "subject role access refresh"(NEW.subject) ;
+  END IF;
+  RETURN NULL;
+END;
+\$\$ LANGUAGE plpgsql;
+
+CREATE TRIGGER "subject role access update" AFTER INSERT OR UPDATE OR DELETE ON "_owner"
+  FOR EACH ROW EXECUTE PROCEDURE "subject role access update"();
+
+CREATE TRIGGER "subject role access update" AFTER INSERT OR UPDATE OR DELETE ON "_read users"
+  FOR EACH ROW EXECUTE PROCEDURE "subject role access update"();
+
+CREATE TRIGGER "subject role access update" AFTER INSERT OR UPDATE OR DELETE ON "_write users"
+  FOR EACH ROW EXECUTE PROCEDURE "subject role access update"();
+
+SELECT "subject role access refresh"(subject) FROM resources ;
+
+EOF
+
 # complete split-phase definitions and redefine as combined phase
 tagdefs_complete
 tagdef()
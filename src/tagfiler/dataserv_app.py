@@ -19,6 +19,7 @@ import urllib
 import web
 import psycopg2
 import os
+import stat
 import tempfile
 import logging
 import itertools
@@ -36,6 +37,13 @@ import string
 from logging.handlers import SysLogHandler
 import base64
 import struct
+import threading
+import Queue
+import socket
+import select
+import hashlib
+import cPickle
+from collections import OrderedDict
 
 import json
 
@@ -355,6 +363,55 @@ def myutf8(v):
     else:
         return v
         
+class ConnectionStates (object):
+    """A process-wide dict of state for each open DB-API connection.
+
+       Pooled web.db objects may reopen their connection, so state such
+       as registered typecasters or prepared statements is kept by the
+       connection itself, and forgotten once that connection is closed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = dict()
+
+    def get(self, db):
+        """Return the state dict for the connection db currently holds, or None."""
+        try:
+            conn = db.ctx.db
+        except AttributeError:
+            return None
+        self.lock.acquire()
+        try:
+            state = self.states.get(conn)
+            if state == None:
+                for old in [ old for old in self.states if old.closed ]:
+                    del self.states[old]
+                state = dict()
+                self.states[conn] = state
+            return state
+        finally:
+            self.lock.release()
+
+connection_states = ConnectionStates()
+
+def db_unicode_connection(db):
+    """Register unicode typecasters on the connection db currently holds, once per connection.
+
+       Returns True if text results from db come back as unicode.
+    """
+    state = connection_states.get(db)
+    if state == None:
+        return False
+    if not state.get('unicode'):
+        # new or reopened connection
+        raw = db._db_cursor().connection
+        raw.set_client_encoding('UTF8')
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, raw)
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY, raw)
+        state['unicode'] = True
+    return True
+
 def db_dbquery(db, query, vars={}):
     """Query wrapper to handle UTF-8 encoding issues.
     
@@ -362,15 +419,21 @@ def db_dbquery(db, query, vars={}):
     
     1. Convert unicode query strings and vars to UTF-8 encoded raw strings.
     
-    2. Convert query results in UTF-8 back to unicode.
+    2. Have the connection decode text results to unicode, falling back
+       to converting each result row if that is not possible.
     """
 
     def myunicode_storage(v):
         return web.Storage( [ (myunicode(key), myunicode(value)) for (key, value) in v.items() ] )
 
+    def myunicode_keys(v):
+        return web.Storage( [ (myunicode(key), value) for (key, value) in v.items() ] )
+
     query = myutf8(query)
     vars = myunicode_storage(vars)
 
+    unicode_values = db_unicode_connection(db)
+
     results = db.query(query, vars=vars)
 
     def iterwrapper(iter):
@@ -380,13 +443,143 @@ def db_dbquery(db, query, vars={}):
     if hasattr(results, '__iter__'):
         # try to map results over iterator
         length = len(results)
-        results = web.iterbetter(iterwrapper(itertools.imap(myunicode_storage, results)))
+        if unicode_values:
+            # rows are used as is unless column names need decoding, as tested on the first row
+            rows = iter(results)
+            first = next(rows, None)
+            if first == None:
+                rows = iter([])
+            else:
+                rows = itertools.chain([ first ], rows)
+                try:
+                    ''.join(first.keys()).decode('ascii')
+                except UnicodeError:
+                    rows = itertools.imap(myunicode_keys, rows)
+        else:
+            rows = itertools.imap(myunicode_storage, results)
+        results = web.iterbetter(iterwrapper(rows))
         results.__len__ = lambda: length
         return results
     else:
         # assume it is not an iterable result
         return myunicode(results)
     
+class PreparedStatements (object):
+    """Per-connection registry of server-side prepared statements.
+
+       Query texts seen at least 'prepare threshold' times in this process
+       are PREPAREd on the connection running them and then run via
+       EXECUTE, so PostgreSQL skips re-parsing and re-planning them.  At
+       most 'prepared statements per connection' statements are kept per
+       connection, deallocating the least recently used ones.
+
+       web.db style $name parameters become positional parameters whose
+       types PostgreSQL infers from the statement.  PREPARE runs inside a
+       savepoint, so a statement PostgreSQL cannot prepare, e.g. for lack
+       of parameter type information, runs unprepared instead of
+       aborting the transaction, and is never prepared again.
+
+       Statements are kept per version as well as query text, so that a
+       query compiled against tagdefs which changed since, e.g. a tag
+       recreated with another dbtype, never reuses a plan of the old one.
+    """
+
+    threshold = 2
+    max_statements = 64
+    max_seen = 4096
+    param_pattern = re.compile(r'[$]([a-zA-Z_][a-zA-Z0-9_]*)')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # seen[query] = count in LRU order
+        self.seen = OrderedDict()
+
+    def count(self, query):
+        """Count query and return its count, or None if it failed to prepare before."""
+        self.lock.acquire()
+        try:
+            count = self.seen.pop(query, 0)
+            if count != None:
+                count += 1
+            self.seen[query] = count
+            while len(self.seen) > PreparedStatements.max_seen:
+                self.seen.popitem(last=False)
+            return count
+        finally:
+            self.lock.release()
+
+    def registry(self, db):
+        """Return the statement LRU for the connection db currently holds, or None."""
+        state = connection_states.get(db)
+        if state == None:
+            return None
+        # new or reopened connection has no statements prepared
+        return state.setdefault('prepared statements', OrderedDict())
+
+    def statement(self, db, query, version=None):
+        """Return (name, params) for a prepared form of query under version, or None to run query as is."""
+        count = self.count(query)
+        if count == None or count < getParamEnv('prepare threshold', PreparedStatements.threshold):
+            return None
+
+        statements = self.registry(db)
+        if statements == None:
+            return None
+
+        key = (version, query)
+        entry = statements.pop(key, None)
+        if entry == None:
+            params = []
+            def param(m):
+                if m.group(1) not in params:
+                    params.append(m.group(1))
+                # doubled so web.db passes a literal $N to the server
+                return '$$%d' % (params.index(m.group(1)) + 1)
+            # unescape web.db '$$' literals before parameter substitution and restore afterward
+            prepared = PreparedStatements.param_pattern.sub(param, query.replace('$$', '\0')).replace('\0', '$$')
+            name = 'tagfiler_%s' % hashlib.md5('%s %s' % (version, query)).hexdigest()
+            db.query('SAVEPOINT prepare_statement')
+            try:
+                db.query('PREPARE %s AS %s' % (name, prepared))
+            except psycopg2.Error, e:
+                db.query('ROLLBACK TO SAVEPOINT prepare_statement')
+                web.debug('PreparedStatements: running query unprepared', str(e))
+                self.lock.acquire()
+                try:
+                    self.seen[query] = None
+                finally:
+                    self.lock.release()
+                return None
+            db.query('RELEASE SAVEPOINT prepare_statement')
+            entry = (name, params)
+
+            max_statements = getParamEnv('prepared statements per connection', PreparedStatements.max_statements)
+            while len(statements) >= max_statements:
+                oldkey, oldentry = statements.popitem(last=False)
+                db.query('DEALLOCATE %s' % oldentry[0])
+
+        statements[key] = entry
+        return entry
+
+prepared_statements = PreparedStatements()
+
+def db_dbquery_prepared(db, query, vars={}, version=None):
+    """Query wrapper like db_dbquery() but using a prepared statement for recurring query texts.
+
+       Only suitable for single SELECT, INSERT, UPDATE, DELETE, or VALUES
+       statements.  Queries depending on tagdefs must pass the tagdefs
+       version, so plans are not reused once tagdefs change.
+    """
+    statement = prepared_statements.statement(db, myutf8(query), version)
+    if statement == None:
+        return db_dbquery(db, query, vars)
+    name, params = statement
+    if params:
+        query = 'EXECUTE %s(%s)' % (name, ', '.join([ '$%s' % p for p in params ]))
+    else:
+        query = 'EXECUTE %s' % name
+    return db_dbquery(db, query, vars)
+
 class Values (object):
     """Simple helper class to build up a set of values and return keys suitable for web.db.query."""
     def __init__(self):
@@ -406,6 +599,367 @@ class Values (object):
     def pack(self):
         return dict([ ('v%d' % i, self.va[i]) for i in range(0, len(self.va)) ])
 
+class QueryParam (object):
+    """A literal value of a query path bound as a named query parameter instead of inlined.
+
+       The placeholder is '$name', or a ('$lower', '$upper') pair for
+       value ranges, and wrapval() returns it in place of a SQL literal.
+    """
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+
+    def __cmp__(self, other):
+        return cmp(self.placeholder, getattr(other, 'placeholder', other))
+
+def bindval(value, dbtype, range_extensions=False):
+    """Downcast value for dbtype into the query parameter form of its wrapval() literal."""
+    def param(v):
+        if dbtype in [ 'boolean', 'int8', 'float8', 'bytea' ]:
+            return v
+        return '%s' % v
+
+    value = downcast_value(dbtype, value, range_extensions)
+    if type(value) == tuple:
+        return tuple([ param(v) for v in value ])
+    return param(value)
+
+class StreamedQuery (object):
+    """A query result fetched lazily through Application.dbstream() when iterated.
+
+       Returned by request bodies in place of a result list so rows can be
+       rendered after the request transaction commits without holding the
+       whole result in worker memory.
+    """
+
+    def __init__(self, app, query, values):
+        self.app = app
+        self.query = query
+        self.values = values
+
+    def __iter__(self):
+        return self.app.dbstream(self.query, self.values)
+
+class StreamedCopy (object):
+    """A COPY ... TO STDOUT statement run through Application.dbstream_copy() when iterated."""
+
+    def __init__(self, app, query):
+        self.app = app
+        self.query = query
+
+    def __iter__(self):
+        return self.app.dbstream_copy(self.query)
+
+class QueryPlan (object):
+    """An EXPLAIN plan returned by request bodies in place of path query results."""
+
+    def __init__(self, query, plan):
+        self.query = query
+        self.plan = plan
+
+def explain_plan(results):
+    """Return the decoded plan from EXPLAIN (FORMAT JSON) result rows."""
+    plan = results[0]['QUERY PLAN']
+    if type(plan) in [ str, unicode ]:
+        plan = jsonReader(plan)
+    return plan
+
+# catalog_id -> whether catalog database has the "cache versions" table
+cache_versions_tables = dict()
+
+def cache_versions_supported(db, catalog_id):
+    """Return True if catalog has trigger-maintained "cache versions" rows.
+
+       Catalogs cloned from an older template lack the table, in which case
+       DbCache falls back to computing freshness from the txid tags.
+    """
+    if catalog_id == None:
+        return False
+    supported = cache_versions_tables.get(catalog_id)
+    if supported == None:
+        results = db_dbquery(db, "SELECT count(*) AS count FROM pg_catalog.pg_tables WHERE tablename = 'cache versions'")
+        supported = results[0].count > 0
+        cache_versions_tables[catalog_id] = supported
+    return supported
+
+def subject_access_supported(db, catalog_id):
+    """Return True if catalog has the trigger-maintained "subject role access" index.
+
+       Catalogs cloned from an older template lack the table, in which case
+       the query compiler falls back to testing the _owner, "_read users"
+       and "_write users" tags directly.  The answer is kept in
+       catalog_cache, so a later dbsetup upgrade is seen once it expires.
+    """
+    if catalog_id == None:
+        return False
+
+    def fill():
+        results = db_dbquery(db, "SELECT count(*) AS count FROM pg_catalog.pg_tables WHERE tablename = 'subject role access'")
+        return results[0].count > 0
+
+    return catalog_cache.select_feature(catalog_id, 'subject role access', fill)
+
+def select_cache_versions(db, catalog_id):
+    """Return dict idtag -> txid of all "cache versions" rows, or None if unsupported by catalog."""
+    if not cache_versions_supported(db, catalog_id):
+        return None
+    return dict([ (r.idtag, r.txid) for r in db_dbquery_prepared(db, 'SELECT idtag, txid FROM "cache versions"') ])
+
+# cache directories refused by private_cache_dir(), so each is only logged once
+unsafe_cache_dirs = set()
+
+def private_cache_dir(dirname):
+    """Return dirname, created private to the daemon account if missing, or None if it is unsafe.
+
+       An existing directory must be a real directory owned by the daemon
+       account and not writable by group or others, since other local
+       users could otherwise plant cache entries.
+    """
+    if not dirname:
+        return None
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname, 0700)
+        except OSError:
+            pass
+    try:
+        st = os.lstat(dirname)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        if dirname not in unsafe_cache_dirs:
+            unsafe_cache_dirs.add(dirname)
+            logger.error('tagfiler: not using cache directory "%s" which must be owned by uid %d and not group or world writable'
+                         % (dirname, os.geteuid()))
+        return None
+    return dirname
+
+class SharedCache (object):
+    """An optional host-wide cache tier shared by all worker processes.
+
+       Enabled by setting 'shared cache dir', ideally to a directory on a
+       memory-backed filesystem such as /dev/shm.  Each entry is a pickle of
+       (version, value) in its own file, replaced atomically by rename so
+       readers never observe a partial write.  Entries not rewritten within
+       'shared cache seconds' are removed by periodic purges, which also
+       remove the least recently written entries beyond 'shared cache
+       entries'.  Since entries are unpickled, the directory must be
+       private to the daemon account, see private_cache_dir().
+    """
+
+    purge_interval_seconds = 60
+    max_cache_seconds = 300
+    max_entries = 10000
+
+    def __init__(self):
+        self.last_purge_time = 0
+        self.puts = 0
+
+    def dirname(self):
+        return private_cache_dir(getParamEnv('shared cache dir', None))
+
+    def filename(self, dirname, key):
+        return os.path.join(dirname, hashlib.md5(repr(key)).hexdigest())
+
+    def get(self, key, version=None):
+        """Return value stored for key, or None if absent or stored with a different version."""
+        dirname = self.dirname()
+        if not dirname:
+            return None
+        try:
+            f = open(self.filename(dirname, key), 'rb')
+            try:
+                if os.fstat(f.fileno()).st_uid != os.geteuid():
+                    return None
+                stored_key, stored_version, value = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError, ValueError):
+            return None
+        if stored_key != key or (version != None and stored_version != version):
+            return None
+        return value
+
+    def put(self, key, version, value):
+        dirname = self.dirname()
+        if not dirname:
+            return
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump((key, version, value), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmpname, self.filename(dirname, key))
+        except (IOError, OSError, cPickle.PicklingError), e:
+            web.debug('SharedCache: failed to store entry', e)
+        self.puts += 1
+        self.purge(dirname)
+
+    def purge(self, dirname):
+        now = time.time()
+        max_entries = getParamEnv('shared cache entries', SharedCache.max_entries)
+        # purge early when this process alone may have stored a tenth of the entry budget
+        if (now - self.last_purge_time) < SharedCache.purge_interval_seconds and self.puts < max_entries / 10:
+            return
+        self.last_purge_time = now
+        self.puts = 0
+        max_age = getParamEnv('shared cache seconds', SharedCache.max_cache_seconds)
+        entries = []
+        for name in os.listdir(dirname):
+            try:
+                filename = os.path.join(dirname, name)
+                mtime = os.path.getmtime(filename)
+                if (now - mtime) > max_age:
+                    os.unlink(filename)
+                else:
+                    entries.append( (mtime, filename) )
+            except OSError:
+                # concurrently purged or replaced by another process
+                pass
+        entries.sort()
+        for mtime, filename in entries[0:max(0, len(entries) - max_entries)]:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+shared_cache = SharedCache()
+
+class ResponseCache (object):
+    """An optional host-wide cache of rendered response bodies keyed by ETag.
+
+       Enabled by setting 'response cache dir'.  Each body is streamed into
+       a temporary file while it is sent to the first client and renamed
+       into place only once complete.  Hits refresh the file mtime, so the
+       periodic purge can evict least recently used bodies until the total
+       size is under 'response cache bytes'.  Bodies larger than a tenth of
+       that budget are not kept.
+    """
+
+    purge_interval_seconds = 60
+    max_cache_bytes = 256 * 1024 * 1024
+
+    def __init__(self):
+        self.last_purge_time = 0
+
+    def dirname(self):
+        return private_cache_dir(getParamEnv('response cache dir', None))
+
+    def filename(self, dirname, key):
+        return os.path.join(dirname, hashlib.md5(repr(key)).hexdigest())
+
+    def get(self, key):
+        """Return open file holding stored body for key, or None if absent."""
+        dirname = self.dirname()
+        if not dirname:
+            return None
+        filename = self.filename(dirname, key)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            # refresh recency for LRU eviction
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return f
+
+    def replay(self, f, chunkbytes):
+        """Yield stored body from f in chunks, closing f when done."""
+        try:
+            f.seek(0, 2)
+            length = f.tell()
+            for buf in yieldBytes(f, 0, length - 1, chunkbytes):
+                yield buf
+        finally:
+            f.close()
+
+    def tee(self, key, chunks):
+        """Yield chunks while storing them as body for key if they complete."""
+        dirname = self.dirname()
+        if not dirname:
+            try:
+                for buf in chunks:
+                    yield buf
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            return
+
+        max_bytes = getParamEnv('response cache bytes', ResponseCache.max_cache_bytes) / 10
+        nbytes = 0
+        f = None
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            f = os.fdopen(fd, 'wb')
+        except (IOError, OSError), e:
+            web.debug('ResponseCache: failed to create entry', e)
+
+        try:
+            for buf in chunks:
+                if f != None:
+                    data = buf
+                    if type(data) == unicode:
+                        # web.py sends unicode chunks as UTF-8
+                        data = data.encode('utf8')
+                    elif type(data) not in [ str, bytearray ]:
+                        data = None
+                    if data != None:
+                        nbytes += len(data)
+                    if data == None or nbytes > max_bytes:
+                        f.close()
+                        f = None
+                        os.unlink(tmpname)
+                    else:
+                        f.write(data)
+                yield buf
+            if f != None:
+                f.close()
+                f = None
+                os.rename(tmpname, self.filename(dirname, key))
+        finally:
+            # release upstream resources such as database cursors before the generator is collected
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            # incomplete bodies due to errors or disconnects are discarded
+            if f != None:
+                f.close()
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+        self.purge(dirname)
+
+    def purge(self, dirname):
+        now = time.time()
+        if (now - self.last_purge_time) < ResponseCache.purge_interval_seconds:
+            return
+        self.last_purge_time = now
+        max_bytes = getParamEnv('response cache bytes', ResponseCache.max_cache_bytes)
+        entries = []
+        total = 0
+        for name in os.listdir(dirname):
+            try:
+                st = os.stat(os.path.join(dirname, name))
+            except OSError:
+                continue
+            entries.append( (st.st_mtime, st.st_size, name) )
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(dirname, name))
+            except OSError:
+                # concurrently purged or replaced by another process
+                pass
+            total -= size
+
+response_cache = ResponseCache()
+
 class DbCache (object):
     """A little helper to share state between web requests."""
 
@@ -415,28 +969,40 @@ class DbCache (object):
         self.cache = dict()
         self.fill_txid = None
 
-    def select(self, db, fillfunc, idtagval=None):
-        def latest_txid():
-            # modified time is latest modification time of:
-            #  identifying tag (tracked as "tag last modified txid" on its tagdef
-            #  individual subjects (tracked as "subject last tagged txid" on each identified subject
-            results = db_dbquery(db, 'SELECT max(txid) AS txid FROM ('
-                              + 'SELECT max(value) AS txid FROM %s' % wraptag('subject last tagged txid')
-                              + ' WHERE subject IN (SELECT subject FROM "_tags present" WHERE value = $idtag)'
-                              + ' UNION ALL '
-                              + 'SELECT value AS txid FROM %s' % wraptag('tag last modified txid')
-                              + ' WHERE subject IN (SELECT subject FROM %s WHERE value = $idtag)) AS a' % wraptag('tagdef'),
-                              vars=dict(idtag=self.idtagname))
-            return results[0].txid
-
-        latest = latest_txid()
+    def latest_txid(self, db, catalog_id=None):
+        if cache_versions_supported(db, catalog_id):
+            # trigger-maintained version row published by tagdef and view writes
+            results = db_dbquery_prepared(db, 'SELECT txid FROM "cache versions" WHERE idtag = $idtag',
+                                          vars=dict(idtag=self.idtagname))
+            if len(results) > 0:
+                return results[0].txid
+
+        # modified time is latest modification time of:
+        #  identifying tag (tracked as "tag last modified txid" on its tagdef
+        #  individual subjects (tracked as "subject last tagged txid" on each identified subject
+        results = db_dbquery_prepared(db, 'SELECT max(txid) AS txid FROM ('
+                                      + 'SELECT max(value) AS txid FROM %s' % wraptag('subject last tagged txid')
+                                      + ' WHERE subject IN (SELECT subject FROM "_tags present" WHERE value = $idtag)'
+                                      + ' UNION ALL '
+                                      + 'SELECT value AS txid FROM %s' % wraptag('tag last modified txid')
+                                      + ' WHERE subject IN (SELECT subject FROM %s WHERE value = $idtag)) AS a' % wraptag('tagdef'),
+                                      vars=dict(idtag=self.idtagname))
+        return results[0].txid
+
+    def select(self, db, fillfunc, idtagval=None, catalog_id=None, shared_key=None):
+        latest = self.latest_txid(db, catalog_id)
         
         if self.fill_txid == None or latest > self.fill_txid:
-            # need to refill cache
-            if self.idalias:
-                self.cache = dict( [ (res[self.idalias], res) for res in fillfunc() ] )
-            else:
-                self.cache = dict( [ (res[self.idtagname], res) for res in fillfunc() ] )
+            # need to refill cache, preferring a copy filled by another process
+            cache = shared_key and shared_cache.get(shared_key, latest)
+            if cache == None:
+                if self.idalias:
+                    cache = dict( [ (res[self.idalias], res) for res in fillfunc() ] )
+                else:
+                    cache = dict( [ (res[self.idtagname], res) for res in fillfunc() ] )
+                if shared_key:
+                    shared_cache.put(shared_key, latest, cache)
+            self.cache = cache
             self.fill_txid = latest
 
             #web.debug('DbCache: filled %s cache txid = %s' % (self.idtagname, self.fill_txid))
@@ -478,18 +1044,308 @@ class PerUserDbCache (object):
         now = datetime.datetime.now(pytz.timezone('UTC'))
         if not ctime:
             cache = DbCache(self.idtagname, self.idalias)
-        results = cache.select(db, fillfunc, idtagval)
+        results = cache.select(db, fillfunc, idtagval, catalog_id, shared_key=(self.idtagname, user, catalog_id))
         self.caches[key] = (now, cache)
         self.purge()
         return results
 
-tagdef_cache = PerUserDbCache('tagdef', 'tagname')
+class TagdefCache (DbCache):
+    """Per-catalog tagdef snapshots shared by all clients.
+
+       The raw tagdef rows of each catalog are read once, without read
+       enforcement.  Per-role views with visibility, readok/writeok, and
+       reftags applied are derived in memory by overlayfunc and kept with
+       the snapshot they came from, keyed by attribute set.
+
+       When the catalog version advances, only tagdef subjects tagged by
+       transactions the snapshot could not see, i.e. since the snapshot
+       xmin of the transaction filling it, are re-fetched with
+       fillfunc(ids).  The version itself is a counter, which gives no
+       such bound.  Overlays of the previous snapshot are patched by
+       overlayfunc(raw, previous, changed) on their next use instead of
+       being rebuilt.
+
+       select() returns (fill_txid, tagdefs) so callers can key derived
+       state on the snapshot version.
+    """
+
+    max_overlays = 256
+
+    def __init__(self):
+        DbCache.__init__(self, 'tagdef', 'tagname')
+        self.lock = threading.Lock()
+        self.snapshots = dict()
+
+    def refresh(self, db, fillfunc, snapshot, latest, since):
+        """Return a new snapshot at version latest, filled since snapshot xmin since, derived from snapshot by delta."""
+        # one pass over all tagdef subjects finds deletions, additions, and modifications
+        results = db_dbquery(db, 'SELECT t.subject AS id, coalesce(s.value >= $txid, True) AS changed'
+                             + ' FROM %s t' % wraptag('tagdef')
+                             + ' LEFT OUTER JOIN %s s USING (subject)' % wraptag('subject last tagged txid'),
+                             vars=dict(txid=snapshot.since))
+        current = dict([ (r.id, r.changed) for r in results ])
+        old = dict([ (tagdef.id, tagdef) for tagdef in snapshot.raw ])
+        refetch = set([ id for id, changed in current.items() if changed or id not in old ])
+
+        if len(refetch) > len(current) / 2:
+            return None
+
+        fresh = refetch and list(fillfunc(refetch)) or []
+        raw = [ tagdef for tagdef in snapshot.raw if tagdef.id in current and tagdef.id not in refetch ] + fresh
+        changed = set([ old[id].tagname for id in old if id not in current or id in refetch ]) \
+            | set([ tagdef.tagname for tagdef in fresh ])
+
+        # carry old overlays forward with the accumulated set of changed tagnames
+        stale = dict([ (roles, (results, changed)) for roles, results in snapshot.overlays.items() ])
+        for roles, entry in snapshot.stale.items():
+            if roles not in stale:
+                stale[roles] = (entry[0], entry[1] | changed)
+        if len(stale) > TagdefCache.max_overlays:
+            stale = dict()
+
+        return web.Storage(txid=latest, since=since, raw=raw, overlays=dict(), stale=stale)
+
+    def select(self, db, fillfunc, overlayfunc, catalog_id, attributes, latest=None):
+        if latest == None:
+            latest = self.latest_txid(db, catalog_id)
+        roles = frozenset(attributes)
+
+        self.lock.acquire()
+        try:
+            snapshot = self.snapshots.get(catalog_id)
+        finally:
+            self.lock.release()
+
+        if snapshot == None or latest > snapshot.txid:
+            shared_key = (self.idtagname, catalog_id, 'snapshot')
+            shared = shared_cache.get(shared_key, latest)
+            if shared != None:
+                since, raw = shared
+                snapshot = web.Storage(txid=latest, since=since, raw=raw, overlays=dict(), stale=dict())
+            else:
+                # read before filling, so every change the fill might miss was made by a transaction at or after it
+                since = db_dbquery(db, 'SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin')[0].xmin
+                if snapshot != None:
+                    snapshot = self.refresh(db, fillfunc, snapshot, latest, since)
+                if snapshot == None:
+                    # need to refill snapshot, dropping all overlays derived from the old one
+                    snapshot = web.Storage(txid=latest, since=since, raw=list(fillfunc()), overlays=dict(), stale=dict())
+                shared_cache.put(shared_key, latest, (snapshot.since, snapshot.raw))
+            self.lock.acquire()
+            try:
+                self.snapshots[catalog_id] = snapshot
+            finally:
+                self.lock.release()
+
+        results = snapshot.overlays.get(roles)
+        if results == None:
+            previous, changed = snapshot.stale.get(roles, (None, None))
+            results = overlayfunc(snapshot.raw, previous, changed)
+            self.lock.acquire()
+            try:
+                if len(snapshot.overlays) >= TagdefCache.max_overlays:
+                    snapshot.overlays.clear()
+                snapshot.overlays[roles] = results
+                snapshot.stale.pop(roles, None)
+            finally:
+                self.lock.release()
+
+        return (snapshot.txid, results)
+
+tagdef_cache = TagdefCache()
 view_cache = PerUserDbCache('view')
 
+class TagTxidCache (object):
+    """Per-catalog map of tagname -> "tag last modified txid" for computing ETags in memory.
+
+       Each map is valid for one value of the 'tags' row of "cache
+       versions", which a trigger increments on every write to "tag last
+       modified txid".  Callers already hold that version from the
+       per-request cache version lookup, so an unchanged catalog costs no
+       query; the small map is refilled in one query after any change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maps = dict()
+
+    def select(self, db, catalog_id, version):
+        self.lock.acquire()
+        try:
+            entry = self.maps.get(catalog_id)
+        finally:
+            self.lock.release()
+
+        if entry == None or entry.version != version:
+            results = db_dbquery_prepared(db, 'SELECT t.value AS tagname, m.value AS txid'
+                                          + ' FROM %s t' % wraptag('tagdef')
+                                          + ' JOIN %s m USING (subject)' % wraptag('tag last modified txid'))
+            entry = web.Storage(version=version, txids=dict([ (r.tagname, r.txid) for r in results ]))
+            self.lock.acquire()
+            try:
+                current = self.maps.get(catalog_id)
+                if current == None or current.version < version:
+                    self.maps[catalog_id] = entry
+            finally:
+                self.lock.release()
+
+        return entry.txids
+
+tag_txid_cache = TagTxidCache()
+
+class CompiledQueryCache (object):
+    """A bounded LRU of compiled path queries shared between web requests.
+
+       Keys must capture everything the compiled SQL depends on: catalog,
+       tagdef snapshot version, client roles, the canonical path, and the
+       compile options.  Values are (query, values) pairs.
+    """
+
+    max_entries = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry != None:
+                # reinsert as most recently used
+                self.entries[key] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, key, entry):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            max_entries = getParamEnv('query cache entries', CompiledQueryCache.max_entries)
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+compiled_query_cache = CompiledQueryCache()
+
+def querypath_key(v, tags=None):
+    """Return a hashable canonical form of a query path or fragment.
+
+       Tag names of all predicates are added to the optional 'tags' set.
+    """
+    if hasattr(v, 'is_subquery'):
+        return ('subquery', querypath_key(v.path, tags))
+    elif isinstance(v, QueryParam):
+        return ('param', v.placeholder)
+    elif type(v) in [ list, tuple ]:
+        return tuple([ querypath_key(x, tags) for x in v ])
+    elif isinstance(v, dict):
+        if tags != None and v.has_key('tag'):
+            tags.add(v['tag'])
+        return tuple([ (key, querypath_key(x, tags)) for key, x in sorted(v.items()) ])
+    else:
+        return v
+
+class CatalogCache (object):
+    """A process-wide cache of catalog registry rows and content ACL decisions.
+
+       Entries are stamped with the registry version current when they
+       were filled and are only trusted while that version is unchanged.
+       Catalog writes bump the version after they commit.  Entries also
+       expire after 'catalog cache seconds', which bounds how long
+       registry changes made by other processes go unobserved, so
+       steady-state requests do not read the registry at all.
+    """
+
+    max_cache_seconds = 60
+    purge_interval_seconds = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.catalogs = dict()
+        self.acls = dict()
+        self.features = dict()
+        self.last_purge_time = None
+
+    def max_age(self):
+        return getParamEnv('catalog cache seconds', CatalogCache.max_cache_seconds)
+
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.version += 1
+            self.catalogs.clear()
+            self.acls.clear()
+            self.features.clear()
+        finally:
+            self.lock.release()
+
+    def purge(self, now):
+        if self.last_purge_time and (now - self.last_purge_time) < CatalogCache.purge_interval_seconds:
+            return
+        self.last_purge_time = now
+        max_age = self.max_age()
+        for entries in [ self.catalogs, self.acls, self.features ]:
+            for key, entry in entries.items():
+                version, ctime, value = entry
+                if version != self.version or (now - ctime) > max_age:
+                    entries.pop(key, None)
+
+    def _get(self, entries, key):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            version, ctime, value = entries.get(key, (None, None, None))
+            if version == self.version and (now - ctime) <= self.max_age():
+                return (True, value)
+            return (False, self.version)
+        finally:
+            self.lock.release()
+
+    def _put(self, entries, key, version, value):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if version == self.version:
+                entries[key] = (version, now, value)
+            self.purge(now)
+        finally:
+            self.lock.release()
+
+    def select(self, entries, key, fillfunc):
+        """Return cached value for key or fill it using fillfunc()."""
+        hit, value = self._get(entries, key)
+        if hit:
+            return value
+        # value is the version in effect before the fill
+        version = value
+        value = fillfunc()
+        self._put(entries, key, version, value)
+        return value
+
+    def select_catalog(self, catalog_id, active, fillfunc):
+        return self.select(self.catalogs, (catalog_id, active), fillfunc)
+
+    def select_acl(self, catalog_id, active, acl_list, attrs, client, fillfunc):
+        return self.select(self.acls, (catalog_id, active, acl_list, frozenset(attrs), client), fillfunc)
+
+    def select_feature(self, catalog_id, feature, fillfunc):
+        """Return whether catalog database has feature, e.g. a table added by a newer dbsetup."""
+        return self.select(self.features, (catalog_id, feature), fillfunc)
+
+catalog_cache = CatalogCache()
+
 def wraptag(tagname, suffix='', prefix='_'):
     return '"' + prefix + tagname.replace('"','""') + suffix + '"'
 
 def wrapval(value, dbtype=None, range_extensions=False):
+    if isinstance(value, QueryParam):
+        return value.placeholder
+
     if value == None:
         return 'NULL'
     
@@ -511,6 +1367,35 @@ def wrapval(value, dbtype=None, range_extensions=False):
     else:
         return "'%s'" % value.replace("'", "''").replace("%", "%%").replace("$", "$$")
     
+def keyset_where(keyexprs, keys):
+    """Build WHERE clause selecting rows ordered strictly after keys.
+
+       keyexprs is a list of (expr, dir, dbtype) in ORDER BY sequence
+       with NULLS LAST semantics; the final expr must be non-null and
+       unique, e.g. the subject id.
+    """
+    clauses = []
+    equals = []
+    for i in range(0, len(keyexprs)):
+        expr, dir, dbtype = keyexprs[i]
+        key = keys[i]
+        op = { ':desc:': '<' }.get(dir, '>')
+        if key == None:
+            # nothing sorts after NULL in NULLS LAST order
+            clauses.append(None)
+            equals.append('%s IS NULL' % expr)
+        elif i == len(keyexprs) - 1:
+            clauses.append('%s %s %s' % (expr, op, wrapval(key, dbtype)))
+        else:
+            clauses.append('(%s %s %s OR %s IS NULL)' % (expr, op, wrapval(key, dbtype), expr))
+            equals.append('%s = %s' % (expr, wrapval(key, dbtype)))
+        if clauses[-1]:
+            clauses[-1] = ' AND '.join(equals[0:i] + [ clauses[-1] ])
+    clauses = [ c for c in clauses if c ]
+    if not clauses:
+        return 'False'
+    return ' OR '.join([ '(%s)' % c for c in clauses ])
+
 def wraparray(iter):
     """Wraps an iterable as for use as a postgres ARRAY."""
     # TODO(rs): should take 'dbtype' param and pass to wrapval
@@ -673,6 +1558,125 @@ class RuntimeError (WebException):
         desc = u'The request execution encountered a runtime error: %s.'
         WebException.__init__(self, ast, status, headers=headers, data=data, desc=desc)
 
+class ClientDisconnected (IOError):
+    "raised to abandon work for a client which has closed its connection"
+    pass
+
+def client_socket(env):
+    """Return the client socket of a WSGI request, or None if the server does not expose one.
+
+       Servers which hide the socket, such as mod_wsgi, still report
+       disconnects by failing a write and closing the response iterator.
+    """
+    sock = env.get('gunicorn.socket')
+    if sock != None:
+        return sock
+    rfile = env.get('wsgi.input')
+    # CherryPy style servers wrap the socket file object of the connection
+    rfile = getattr(rfile, 'rfile', rfile)
+    return getattr(rfile, '_sock', None)
+
+# POLLRDHUP is Linux specific and missing from the select module of older Pythons
+POLLRDHUP = getattr(select, 'POLLRDHUP', 0x2000)
+
+def socket_disconnected(sock):
+    """Return True if the peer of sock has hung up, False if not, or None if the check fails.
+
+       Uses poll() rather than select(), which cannot handle descriptors
+       above FD_SETSIZE, and never consumes input.
+    """
+    try:
+        poller = select.poll()
+        poller.register(sock, select.POLLHUP | select.POLLERR | POLLRDHUP)
+        events = poller.poll(0)
+    except (socket.error, select.error, ValueError, TypeError):
+        return None
+    for fd, mask in events:
+        if mask & (select.POLLHUP | select.POLLERR | POLLRDHUP):
+            return True
+    return False
+
+class DisconnectWatch (object):
+    """A registration of conn with disconnect_watcher, set by its owner when done with conn."""
+
+    def __init__(self, watcher, app, conn):
+        self.watcher = watcher
+        self.app = app
+        self.conn = conn
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.done = False
+
+    def poll(self):
+        """Cancel the statement running on conn if the client has gone and the owner is not done."""
+        self.lock.acquire()
+        try:
+            # done is tested under the lock so a cancel cannot follow set() onto a later statement such as COMMIT
+            if not self.done and self.app.client_disconnected():
+                self.conn.cancel()
+                self.done = True
+        finally:
+            self.lock.release()
+
+    def set(self):
+        self.lock.acquire()
+        try:
+            self.done = True
+        finally:
+            self.lock.release()
+        self.watcher.discard(self)
+
+class DisconnectWatcher (object):
+    """One helper thread per process polling the clients of running statements for disconnects.
+
+       Watches younger than 'disconnect poll seconds' are not polled, so
+       short statements only cost a registration.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watches = set()
+        self.pid = None
+
+    def watch(self, app, conn):
+        watch = DisconnectWatch(self, app, conn)
+        self.lock.acquire()
+        try:
+            self.watches.add(watch)
+            if self.pid != os.getpid():
+                # not started yet, or started in a parent process before fork
+                self.pid = os.getpid()
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.lock.release()
+        return watch
+
+    def discard(self, watch):
+        self.lock.acquire()
+        try:
+            self.watches.discard(watch)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            interval = getParamEnv('disconnect poll seconds', Application.disconnect_poll_seconds)
+            time.sleep(interval)
+            now = time.time()
+            self.lock.acquire()
+            try:
+                watches = [ watch for watch in self.watches if (now - watch.start) >= interval ]
+            finally:
+                self.lock.release()
+            for watch in watches:
+                watch.poll()
+                if watch.done:
+                    self.discard(watch)
+
+disconnect_watcher = DisconnectWatcher()
+
 def getParamEnv(suffix, default=None):
     return global_env.get(suffix, default)
 
@@ -747,6 +1751,7 @@ class CatalogRequest (webauthn2_handler_factory.RestHandler):
         self.http_etag = None
         
         self.config = web.Storage(global_env.items())
+        self.catalogs_changed = False
         
         self.context = Context()
         try:
@@ -826,7 +1831,13 @@ class CatalogRequest (webauthn2_handler_factory.RestHandler):
             return body()
 
         # run under transaction control implemented by our parent class
-        bodyval = self._db_wrapper(db_body)
+        try:
+            bodyval = self._db_wrapper(db_body)
+        finally:
+            # invalidate even on failure since a retry may have committed
+            if self.catalogs_changed:
+                catalog_cache.invalidate()
+                self.catalogs_changed = False
 
         for msg in self.logmsgs:
             logger.info(myutf8(msg))
@@ -890,12 +1901,19 @@ class CatalogRequest (webauthn2_handler_factory.RestHandler):
     def acl_check(self, catalog_id=None, active=True, acl_list=None, 
                   attrs=[], admin=None):
         """Checks to see if the user is in the ACL for the specified catalog.
-        """
         
+        Registry rows and decisions are memoized in catalog_cache, so 
+        repeated checks for the same catalog and roles skip the registry.
+        """
+
         def body():
-            catalogs = self.select_catalogs(catalog_id=catalog_id, 
-                                            active=active, acl_list=None, 
-                                            attrs=attrs, admin=admin)
+            return self.select_catalogs(catalog_id=catalog_id, 
+                                        active=active, acl_list=None, 
+                                        attrs=attrs, admin=admin)
+
+        def decide():
+            catalogs = catalog_cache.select_catalog(catalog_id, active,
+                                                    lambda: self.dbtransact(body, lambda result: result))
             if len(catalogs) == 0:
                 return False
             
@@ -907,7 +1925,8 @@ class CatalogRequest (webauthn2_handler_factory.RestHandler):
             else:
                 return True
 
-        return self.dbtransact(body, lambda result: result)
+        return catalog_cache.select_acl(catalog_id, active, acl_list, attrs, 
+                                        self.context.client, decide)
 
 
 class CatalogManager (CatalogRequest):
@@ -930,6 +1949,7 @@ class CatalogManager (CatalogRequest):
         
         # Delete toggles the 'active' flag to false, to deactive this catalog
         self.dbquery("UPDATE catalogs SET active = false WHERE id = %d" % catalog_id)
+        self.catalogs_changed = True
 
 
     def _create_db(self, dbname):
@@ -998,6 +2018,7 @@ class CatalogManager (CatalogRequest):
                  + "config = %(config)s " % wrapped
                  + "WHERE id = %d" % catalog.id)
         self.dbquery(query)
+        self.catalogs_changed = True
 
 
     def create_catalog(self, catalog):
@@ -1047,6 +2068,7 @@ class CatalogManager (CatalogRequest):
                      + "(owner, write_users, read_users, config) "
                      + "VALUES (%(owner)s, ARRAY[%(write_users)s]::text[], ARRAY[%(read_users)s]::text[], %(config)s)" % wrapped)
         self.dbquery(query)
+        self.catalogs_changed = True
         
         # Now get the catalog_id of the last entered catalog
         results = self.dbquery("SELECT max(id) as last_id FROM catalogs")
@@ -1066,6 +2088,15 @@ class CatalogManager (CatalogRequest):
 class Application (DatabaseConnection):
     "common parent class of all service handler classes to use db etc."
 
+    stream_fetch_rows = 1000
+    stream_copy_chunks = 64
+    stream_copy_bytes = 64 * 1024
+    range_sample_rows = 100000
+    disconnect_poll_seconds = 1.0
+
+    # web methods tested against the content read ACL rather than the write ACL
+    read_methods = [ 'GET', 'HEAD' ]
+
     def select_view_all(self):
         return self.select_files_by_predlist(subjpreds=[ web.Storage(tag='view', op=None, vals=[]) ],
                                              listtags=[ 'view', "view tags" ])
@@ -1206,6 +2237,41 @@ class Application (DatabaseConnection):
         self.http_etag = '"%s"' % ';'.join(etag).replace('"', '\\"')
         #web.debug(self.http_etag)
 
+    def response_cache_lookup(self, contentType):
+        """Prepare to replay or store the rendered body for the current ETag in response_cache.
+
+           The key adds the scheme and host, request URI, content type,
+           and client roles to self.http_etag, since the ETag alone does
+           not identify the body, which may embed links to the host.
+           Returns True if a stored body will be replayed.
+        """
+        if self.response_replay != None:
+            # a lookup from an earlier attempt of a retried transaction
+            self.response_replay.close()
+            self.response_replay = None
+        self.response_cache_key = None
+        if self.http_etag is None or not response_cache.dirname():
+            return False
+        if self.queryopts.has_key('after'):
+            # next page Link header depends on the rows themselves
+            return False
+        roles = list(self.context.attributes)
+        roles.sort()
+        self.response_cache_key = (self.catalog_id, web.ctx.home, web.ctx.fullpath, contentType, tuple(roles), self.http_etag)
+        self.response_replay = response_cache.get(self.response_cache_key)
+        return self.response_replay != None
+
+    def response_cache_render(self, contentType, chunks):
+        """Yield response body from response_cache if looked up, otherwise yield chunks storing them."""
+        if self.response_replay != None:
+            self.header('Content-Type', contentType)
+            self.header('Content-Length', str(os.fstat(self.response_replay.fileno()).st_size))
+            return self.client_checked(response_cache.replay(self.response_replay, self.config['chunk bytes']))
+        elif self.response_cache_key != None:
+            return self.client_checked(response_cache.tee(self.response_cache_key, chunks))
+        else:
+            return self.client_checked(chunks)
+
     def http_is_cached(self):
         """Determine whether a request is cached and the request can return 304 Not Modified.
            Currently only considers ETags via HTTP "If-None-Match" header, if caller set self.http_etag.
@@ -1252,7 +2318,7 @@ class Application (DatabaseConnection):
         self.http_vary = catalog_req.http_vary.copy()
         
         # Use web method to determine appropriate content acl to test
-        if web.ctx.method in ['GET', 'HEAD']:
+        if web.ctx.method in self.read_methods:
             test_acl = catalog_req.CONFIG_CONTENT_READ_USERS
         else:
             test_acl = catalog_req.CONFIG_CONTENT_WRITE_USERS
@@ -1285,6 +2351,13 @@ class Application (DatabaseConnection):
 
         self.emitted_headers = dict()
         self.http_etag = None
+        self.response_cache_key = None
+        self.response_replay = None
+        self.next_page_uri = None
+        self.query_admission = False
+        self.client_socket = client_socket(web.ctx.env)
+        self.client_gone = False
+        self.client_checktime = None
 
         self.request_guid = base64.b64encode(  struct.pack('Q', random.getrandbits(64)) )
 
@@ -1349,6 +2422,79 @@ class Application (DatabaseConnection):
             self.header('Vary', ', '.join(self.http_vary))
         if self.http_etag:
             self.header('ETag', '%s' % self.http_etag)
+        if self.next_page_uri:
+            self.header('Link', '<%s>; rel="next"' % self.next_page_uri)
+
+    def keyset_after(self, path):
+        """Return page position from 'after' queryopt for keyset pagination of path, or None if not requested.
+
+           A bare 'after' queryopt requests the first page.  Otherwise
+           its value is an opaque token from a previous page's Link
+           header, valid only for the same sort order.
+        """
+        if not self.queryopts.has_key('after'):
+            return None
+        otags = [ t for t, dir in path[-1][2] ]
+        token = self.queryopts['after']
+        if not token:
+            return web.Storage(otags=otags, keys=None, id=None)
+        try:
+            token = str(token)
+            token_otags, keys, id = jsonReader(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        except:
+            raise BadRequest(self, 'Query option "after" has an invalid page token.')
+        if token_otags != otags or len(keys) != len(otags):
+            raise BadRequest(self, 'Query option "after" has a page token for a different sort order.')
+        return web.Storage(otags=otags, keys=keys, id=id)
+
+    def keyset_next_page(self, after, files, limit):
+        """Set next_page_uri from the last row of a full keyset page.
+
+           The internal page key columns are removed from all rows so
+           they are not rendered to the client.
+        """
+        if after == None:
+            return
+
+        def keyval(v):
+            if v == None or type(v) in [ bool, int, long, float, unicode, str ]:
+                return v
+            return '%s' % v
+
+        pagecols = [ 'page key %d' % i for i in range(0, len(after.otags)) ] + [ 'page id' ]
+
+        if limit != None and len(files) >= limit:
+            last = files[-1]
+            keys = [ keyval(last[col]) for col in pagecols[0:-1] ]
+            token = base64.urlsafe_b64encode(jsonWriter([ after.otags, keys, last['page id'] ])).rstrip('=')
+            query = [ opt for opt in web.ctx.query.lstrip('?').split('&') if opt and opt.split('=')[0] != 'after' ]
+            query.append('after=%s' % token)
+            self.next_page_uri = web.ctx.home + web.ctx.path + '?' + '&'.join(query)
+
+        for res in files:
+            for col in pagecols:
+                if col in res:
+                    del res[col]
+
+    def is_subquery_value(self, value, tagdef):
+        """Return True if value is a sub-query, parsed or written as '@(querypath)', for a tag accepting them.
+
+           Only tagref tags and the subject 'id' tag take sub-query
+           values, see build_subquery_values(), so text shaped like
+           '@(...)' is an ordinary value for any other tag.
+        """
+        if not (tagdef.tagref or tagdef.tagname == 'id'):
+            return False
+        if hasattr(value, 'is_subquery'):
+            return True
+        return type(value) in [ str, unicode ] and value.startswith('@(') and value.endswith(')')
+
+    def single_valued_subquery(self, vquery):
+        """Return a scalar SQL sub-select of the one distinct value of sub-query vquery.
+
+           Run statements using it with dbquery_single_valued().
+        """
+        return 'SELECT DISTINCT sq.value FROM (%s) AS sq (value) WHERE sq.value IS NOT NULL' % vquery
 
     def validateSubjectQuery(self, query, tagdef=None, subject=None):
         if type(query) in [ int, long ]:
@@ -1356,15 +2502,23 @@ class Application (DatabaseConnection):
         if query in [ None, [] ]:
             return query
         if type(query) in [ type('string'), unicode ]:
-            ast = self.url_parse_func(query)
+            if query.startswith('@(') and query.endswith(')'):
+                # same sub-query syntax as in a URI predicate value
+                query = query[2:-1]
+            # url_parse imports this module, so only import it once both are loaded
+            import url_lex, url_parse
+            try:
+                ast = self.url_parse_func(query)
+            except (url_lex.LexicalError, url_parse.ParseError):
+                ast = None
             if type(ast) in [ int, long ]:
                 # this is a bare subject identifier
                 return ast
             elif hasattr(ast, 'is_subquery'):
                 query = ast
         if hasattr(query, 'is_subquery') and query.is_subquery:
-            # this holds a subquery expression to evaluate
-            return [ subject.id for subject in self.select_files_by_predlist_path(path=query.path) ]
+            # this holds a subquery expression which stays in SQL, see build_subquery_values()
+            return query
         raise BadRequest(self, 'Sub-query expression "%s" not a valid expression.' % query)
         
 
@@ -1543,7 +2697,43 @@ class Application (DatabaseConnection):
     def postDispatch(self, uri=None):
         pass
 
+    def client_disconnected(self):
+        """Return True once the client is known to have closed its connection."""
+        if not self.client_gone and self.client_socket != None:
+            # an unknown result from a failed check is not a disconnect
+            self.client_gone = socket_disconnected(self.client_socket) == True
+        return self.client_gone
+
+    def cancel_on_disconnect(self, conn):
+        """Watch for client disconnect while conn runs statements, cancelling them if it happens.
+
+           Returns a watch with a set() method which the caller calls
+           when done with conn.  The shared disconnect_watcher polls the
+           client every 'disconnect poll seconds', starting one interval
+           after the watch, and only if the client socket is available.
+        """
+        if self.client_socket == None:
+            return threading.Event()
+        return disconnect_watcher.watch(self, conn)
+
+    def client_checked(self, chunks):
+        """Yield chunks via midDispatch(), closing chunks promptly when the response ends early."""
+        try:
+            for buf in chunks:
+                self.midDispatch()
+                yield buf
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
     def midDispatch(self):
+        # check the client at most once per poll interval since this runs for every streamed chunk
+        checktime = time.time()
+        if self.client_checktime == None \
+                or (checktime - self.client_checktime) >= getParamEnv('disconnect poll seconds', Application.disconnect_poll_seconds):
+            self.client_checktime = checktime
+            if self.client_disconnected():
+                raise ClientDisconnected('client %s closed connection during request %s' % (web.ctx.ip, self.request_guid))
         now = datetime.datetime.now()
         if self.middispatchtime == None or (now - self.middispatchtime).seconds > 30:
             self.preDispatchCore(web.ctx.homepath, setcookie=False)
@@ -1564,6 +2754,199 @@ class Application (DatabaseConnection):
     def dbquery(self, query, vars={}):
         return db_dbquery(self.db, query, vars=vars)
 
+    def dbquery_prepared(self, query, vars={}):
+        return db_dbquery_prepared(self.db, query, vars=vars, version=getattr(self, 'tagdefs_txid', None))
+
+    def dbquery_single_valued(self, query, vars={}, tagnames=[]):
+        """Run query containing single_valued_subquery() expressions for tagnames.
+
+           A sub-query yielding more than one value fails in the
+           database with a cardinality violation, which is a Conflict.
+        """
+        try:
+            return self.dbquery(query, vars=vars)
+        except psycopg2.Error, ev:
+            # 21000 is cardinality_violation, raised by a scalar sub-select with more than one row
+            if ev.pgcode != '21000':
+                raise
+            raise Conflict(self, 'Sub-query for single-valued tag %s yields more than one value.'
+                           % ', '.join([ '"%s"' % tagname for tagname in tagnames ]))
+
+    def dbstream(self, query, vars={}):
+        """Yield result rows of query fetched in batches from a server-side cursor.
+
+           A dedicated pooled connection is used so rows can be consumed
+           after the request transaction has committed.  Batches hold
+           'stream fetch rows' rows, so worker memory stays bounded
+           regardless of result size.
+        """
+        batch = getParamEnv('stream fetch rows', Application.stream_fetch_rows)
+        db = self._get_pooled_connection()
+        try:
+            conn = db._db_cursor().connection
+            unicode_values = db_unicode_connection(db)
+            try:
+                sql = web.db.reparam(myutf8(query), vars)
+                timeout = self.statement_timeout()
+                if timeout != None:
+                    conn.cursor().execute('SET LOCAL statement_timeout = %d' % int(timeout))
+                cur = conn.cursor('tagfiler_stream_%x' % random.getrandbits(64))
+                watch = self.cancel_on_disconnect(conn)
+                try:
+                    cur.execute(sql.query('pyformat'), sql.values())
+                    while True:
+                        try:
+                            rows = cur.fetchmany(batch)
+                        except psycopg2.extensions.QueryCanceledError:
+                            if self.client_gone:
+                                raise ClientDisconnected('client closed connection during streamed query')
+                            raise
+                        if not rows:
+                            break
+                        names = [ myunicode(d[0]) for d in cur.description ]
+                        for row in rows:
+                            if unicode_values:
+                                yield web.Storage(zip(names, row))
+                            else:
+                                yield web.Storage([ (names[i], myunicode(row[i])) for i in range(0, len(names)) ])
+                    cur.close()
+                finally:
+                    watch.set()
+            finally:
+                # read-only, and also ends the cursor on errors or early close by the consumer
+                conn.rollback()
+        finally:
+            self._put_pooled_connection(db)
+
+    def dbstream_copy(self, query):
+        """Yield output of a COPY ... TO STDOUT statement in chunks as PostgreSQL produces it.
+
+           COPY runs in a helper thread on a dedicated pooled connection and
+           hands chunks over a queue bounded by 'stream copy chunks', so a
+           slow client stalls the COPY instead of buffering its output.
+           psycopg2 writes one row at a time, so rows are gathered into
+           chunks of about 'stream copy bytes' before being handed over.
+        """
+        chunks = Queue.Queue(getParamEnv('stream copy chunks', Application.stream_copy_chunks))
+        chunk_bytes = getParamEnv('stream copy bytes', Application.stream_copy_bytes)
+        aborted = threading.Event()
+        db = self._get_pooled_connection()
+        conn = db._db_cursor().connection
+
+        class Sink (object):
+            def __init__(self):
+                self.rows = []
+                self.nbytes = 0
+
+            def write(self, buf):
+                if aborted.isSet():
+                    raise IOError('COPY output consumer went away')
+                self.rows.append(buf)
+                self.nbytes += len(buf)
+                if self.nbytes >= chunk_bytes:
+                    self.flush()
+
+            def flush(self):
+                if self.rows:
+                    chunks.put(''.join(self.rows))
+                    self.rows = []
+                    self.nbytes = 0
+
+        def produce():
+            try:
+                sink = Sink()
+                conn.cursor().copy_expert(query, sink)
+                sink.flush()
+                chunks.put(None)
+            except Exception, e:
+                chunks.put(e)
+
+        timeout = self.statement_timeout()
+        if timeout != None:
+            conn.cursor().execute('SET LOCAL statement_timeout = %d' % int(timeout))
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        watch = self.cancel_on_disconnect(conn)
+        try:
+            while True:
+                buf = chunks.get()
+                if buf is None:
+                    break
+                elif isinstance(buf, Exception):
+                    if self.client_gone:
+                        raise ClientDisconnected('client closed connection during COPY')
+                    raise buf
+                yield buf
+        finally:
+            watch.set()
+            if producer.isAlive():
+                # consumer stopped early, so stop the COPY and unblock the producer
+                aborted.set()
+                conn.cancel()
+                while producer.isAlive():
+                    try:
+                        chunks.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+            producer.join()
+            conn.rollback()
+            self._put_pooled_connection(db)
+
+    def stream_files_by_predlist_path(self, path=None, limit=None, enforce_read_authz=True, offset=None, json=False):
+        """Return StreamedQuery for path query compiled now and fetched when iterated.
+
+           The rows are fetched after commit from a newer snapshot than
+           the ETag, so the rendered body is not stored in response_cache.
+        """
+        query, values = self.build_files_by_predlist_path(path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json)
+        self.admit_query(query, values)
+        self.response_cache_key = None
+        return StreamedQuery(self, query, values)
+
+    def stream_query_limit(self, limit):
+        """Return True if a query with limit is big enough to stream via dbstream()."""
+        return limit == None or limit > getParamEnv('stream fetch rows', Application.stream_fetch_rows)
+
+    def statement_timeout(self):
+        """Return statement_timeout in milliseconds for this client, or None to keep the database default.
+
+           The largest 'role statement timeouts' entry matching a client
+           role, or '*' for everyone, overrides 'statement timeout'.
+        """
+        roles = set(self.context.attributes).union(set(['*']))
+        timeouts = [ ms for role, ms in getParamEnv('role statement timeouts', dict()).items() if role in roles ]
+        if timeouts:
+            return max(timeouts)
+        return getParamEnv('statement timeout', None)
+
+    def admit_query(self, query, values):
+        """Raise Conflict if a query compiled from a client query path has estimated cost above 'query cost limit'."""
+        limit = getParamEnv('query cost limit', None)
+        if limit == None or not self.query_admission:
+            return
+        cost = explain_plan(self.dbquery('EXPLAIN (FORMAT JSON) %s' % query, vars=values))[0]['Plan']['Total Cost']
+        if cost > limit:
+            raise Conflict(self, 'Query estimated cost %d exceeds the limit of %d, so it needs more selective predicates or a smaller limit.' % (cost, limit))
+
+    def query_explain(self):
+        """Return True if the client asked for the query plan with the 'explain' queryopt, which only admins may use."""
+        if not self.queryopts.has_key('explain'):
+            return False
+        if self.config.admin not in self.context.attributes:
+            raise Forbidden(self, 'query plan explanation')
+        return True
+
+    def explain_files_by_predlist_path(self, path, limit=None, offset=None, json=False):
+        """Run path query under EXPLAIN ANALYZE and return a QueryPlan with actual timings."""
+        query, values = self.build_files_by_predlist_path(path, limit=limit, offset=offset, json=json)
+        return QueryPlan(query, explain_plan(self.dbquery('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) %s' % query, vars=values)))
+
+    def query_plan_render(self, plan):
+        self.header('Content-Type', 'application/json')
+        yield jsonWriter(dict(query=plan.query, plan=plan.plan), indent=2) + '\n'
+
     def dbtransact(self, body, postCommit, limit=8):
         """re-usable transaction pattern
 
@@ -1575,6 +2958,14 @@ class Application (DatabaseConnection):
         def db_body(db):
             self.db = db
 
+            if self.client_gone:
+                # don't retry work for a client which went away
+                raise ClientDisconnected('client closed connection during request %s' % self.request_guid)
+
+            timeout = self.statement_timeout()
+            if timeout != None:
+                self.dbquery('SET LOCAL statement_timeout = %d' % int(timeout))
+
             self.logmsgs = []
             self.table_changes = {}
             self.subject = None
@@ -1585,9 +2976,25 @@ class Application (DatabaseConnection):
             # build up globals useful to almost all classes, to avoid redundant coding
             # this is fragile to make things fast and simple
 
-            self.tagdefsdict = dict([ (tagdef.tagname, tagdef) for tagdef in tagdef_cache.select(db, lambda: self.select_tagdef(), self.context.client, self.catalog_id) ])
-
-            return body()
+            versions = select_cache_versions(db, self.catalog_id) or dict()
+            self.tags_version = versions.get('tags')
+            self.tagdefs_txid, tagdefs = tagdef_cache.select(db,
+                                                             lambda ids=None: self.select_tagdef_raw(ids),
+                                                             lambda raw, previous, changed: self.tagdef_authz_overlay(raw, previous, changed),
+                                                             self.catalog_id,
+                                                             self.context.attributes,
+                                                             versions.get('tagdef'))
+            self.tagdefsdict = dict([ (tagdef.tagname, tagdef) for tagdef in tagdefs ])
+
+            watch = self.cancel_on_disconnect(db._db_cursor().connection)
+            try:
+                return body()
+            except psycopg2.extensions.QueryCanceledError:
+                if self.client_gone:
+                    raise ClientDisconnected('client closed connection during request %s' % self.request_guid)
+                raise
+            finally:
+                watch.set()
 
         # run under transaction control implemented by our parent class
         bodyval = self._db_wrapper(db_body)
@@ -1909,6 +3316,19 @@ class Application (DatabaseConnection):
 
         results = list(self.select_files_by_predlist(subjpreds, listtags, ordertags, listas=Application.tagdef_listas, tagdefs=Application.static_tagdefs, enforce_read_authz=enforce_read_authz))
 
+        tagdefs = self.tagdef_annotate(results)
+
+        #web.debug(results)
+        if tagname:
+            if tagname in tagdefs:
+                return [ tagdefs[tagname] ]
+            else:
+                return []
+        else:
+            return results
+
+    def tagdef_annotate(self, results):
+        """Add per-role readok/writeok and reftags to tagdef results, returning a tagname map."""
         tagdefs = dict([ (tagdef.tagname, tagdef) for tagdef in results ])
 
         for tagdef in results:
@@ -1921,15 +3341,91 @@ class Application (DatabaseConnection):
             if tagdef.tagref and not tagdef.softtagref:
                 tagdefs[tagdef.tagref].reftags.add(tagdef.tagname)
 
-        #web.debug(results)
-        if tagname:
-            if tagname in tagdefs:
-                return [ tagdefs[tagname] ]
-            else:
-                return []
-        else:
+        return tagdefs
+
+    def select_tagdef_raw(self, ids=None):
+        """Select tagdefs with their read users, without read enforcement or authz annotation.
+
+           This role-independent snapshot is shared by tagdef_cache.  If
+           'ids' is given, only the tagdefs with those subject ids are
+           selected.
+        """
+        listtags = [ 'owner', 'id', 'read users' ] + Application.tagdef_listas.keys()
+        subjpreds = [ web.Storage(tag='tagdef', op=None, vals=[]) ]
+        if ids:
+            subjpreds.append( web.Storage(tag='id', op='=', vals=list(ids)) )
+        return list(self.select_files_by_predlist(subjpreds, listtags, listas=Application.tagdef_listas, tagdefs=Application.static_tagdefs, enforce_read_authz=False))
+
+    def tagdef_authz_overlay(self, raw, previous=None, changed=None):
+        """Derive the tagdefs visible to this client from a raw snapshot.
+
+           Equivalent to select_tagdef() with read enforcement but computed
+           in memory: tagdef subjects must be owned or readable by the
+           client roles, tag references to invisible tagdefs are hidden, and
+           readok/writeok/reftags are recomputed on private copies.
+
+           If 'previous' overlay results are given, only tagdefs named in
+           'changed', those referencing them, and those they reference are
+           recomputed; other entries are reused from 'previous'.
+        """
+        roles = set(self.context.attributes).union(set(['*']))
+
+        def visible(tagdef):
+            return tagdef.owner in roles or not roles.isdisjoint(set(tagdef['read users'] or []))
+
+        def private(tagdef):
+            tagdef = web.Storage(tagdef)
+            del tagdef['read users']
+            return tagdef
+
+        if previous == None:
+            results = [ private(tagdef) for tagdef in raw if visible(tagdef) ]
+
+            names = set([ tagdef.tagname for tagdef in results ])
+            for tagdef in results:
+                if tagdef.tagref and tagdef.tagref not in names:
+                    tagdef.tagref = None
+
+            self.tagdef_annotate(results)
             return results
 
+        rawdict = dict([ (tagdef.tagname, tagdef) for tagdef in raw ])
+        names = set([ tagdef.tagname for tagdef in raw if visible(tagdef) ])
+
+        # tagdefs whose hidden or visible tagref may flip also need recomputing
+        recompute = set(changed) | set([ tagdef.tagname for tagdef in raw if tagdef.tagref in changed ])
+
+        results = dict([ (tagdef.tagname, tagdef) for tagdef in previous
+                         if tagdef.tagname not in recompute and tagdef.tagname in names ])
+        recomputed = []
+        for tagname in recompute:
+            if tagname in names:
+                tagdef = private(rawdict[tagname])
+                if tagdef.tagref and tagdef.tagref not in names:
+                    tagdef.tagref = None
+                results[tagname] = tagdef
+                recomputed.append(tagdef)
+
+        for tagdef in recomputed:
+            for mode in ['read', 'write']:
+                tagdef['%sok' % mode] = self.test_tag_authz(mode, None, tagdef, tagdefs=results)
+
+        # reftags change for the old and new targets of recomputed tagdefs
+        targets = set([ tagdef.tagref for tagdef in previous if tagdef.tagname in recompute ]) \
+            | set([ results[tagname].tagref for tagname in recompute if tagname in results ])
+        for target in targets:
+            if target in results:
+                tagdef = web.Storage(results[target])
+                tagdef.reftags = set([ td.tagname for td in results.itervalues()
+                                       if td.tagref == target and not td.softtagref ])
+                results[target] = tagdef
+        for tagname in recompute:
+            if tagname in results and tagname not in targets:
+                results[tagname].reftags = set([ td.tagname for td in results.itervalues()
+                                                 if td.tagref == tagname and not td.softtagref ])
+
+        return results.values()
+
     def exists_tagdef(self, tagname, enforce_read_authz=True):
         listtags = [ 'tagdef' ]
 
@@ -2168,7 +3664,7 @@ class Application (DatabaseConnection):
             query += '  ORDER BY value'
 
         #web.debug(query, vars)
-        return self.dbquery(query, vars=vars)
+        return self.dbquery_prepared(query, vars=vars)
 
     def select_tag(self, subject, tagdef, value=None):
         # subject would not be found if read of subject is not OK
@@ -2218,12 +3714,12 @@ class Application (DatabaseConnection):
 
         def insert_or_update(table, vars):
             self.dbquery('LOCK TABLE %s IN EXCLUSIVE MODE' % table)
-            results = self.dbquery('SELECT value FROM %s WHERE subject = $subject'  % table, vars=vars)
+            results = self.dbquery_prepared('SELECT value FROM %s WHERE subject = $subject'  % table, vars=vars)
 
             if len(results) > 0:
                 value = results[0].value
                 if value < vars['now']:
-                    self.dbquery('UPDATE %s SET value = $now WHERE subject = $subject' % table, vars=vars)
+                    self.dbquery_prepared('UPDATE %s SET value = $now WHERE subject = $subject' % table, vars=vars)
                     #web.debug('set %s from %s to %s' % (table, value, vars['now']))
                 elif value == vars['now']:
                     pass
@@ -2231,11 +3727,11 @@ class Application (DatabaseConnection):
                     pass
                     #web.debug('refusing to set %s from %s to %s' % (table, value, vars['now']))
             else:
-                self.dbquery('INSERT INTO %s (subject, value) VALUES ($subject, $now)' % table, vars=vars)
+                self.dbquery_prepared('INSERT INTO %s (subject, value) VALUES ($subject, $now)' % table, vars=vars)
                 #web.debug('set %s to %s' % (table, vars['now']))
 
         now = datetime.datetime.now(pytz.timezone('UTC'))
-        txid = self.dbquery('SELECT txid_current() AS txid')[0].txid
+        txid = self.dbquery_prepared('SELECT txid_current() AS txid')[0].txid
 
         insert_or_update(self.wraptag('tag last modified'), dict(subject=tagdef.id, now=now))
         insert_or_update(self.wraptag('tag last modified txid'), dict(subject=tagdef.id, now=txid))
@@ -2252,6 +3748,38 @@ class Application (DatabaseConnection):
             self.set_tag_lastmodified(None, self.tagdefsdict['writeok'])
             
 
+    def set_tag_subquery(self, subject, tagdef, ast):
+        """Set values of tag on subject from a subquery evaluated by the database.
+
+           A single-valued tag takes the one distinct value of the
+           subquery, and any other number of values is a Conflict.
+        """
+        vquery = self.build_subquery_values(ast, tagdef)
+
+        if not tagdef.multivalue:
+            results = self.dbquery_single_valued('SELECT (%s) AS value' % self.single_valued_subquery(vquery),
+                                                 tagnames=[ tagdef.tagname ])
+            if results[0].value == None:
+                raise Conflict(self, 'Sub-query for single-valued tag "%s" must yield exactly one value.' % tagdef.tagname)
+            return self.set_tag(subject, tagdef, results[0].value)
+
+        results = self.dbquery(('INSERT INTO %(table)s (subject, value)'
+                                + ' SELECT DISTINCT $subject, sq.value FROM (%(vquery)s) AS sq (value)'
+                                + ' WHERE sq.value IS NOT NULL'
+                                + ' AND NOT EXISTS (SELECT 1 FROM %(table)s t WHERE t.subject = $subject AND t.value = sq.value)'
+                                + ' RETURNING value'
+                                ) % dict(table=self.wraptag(tagdef.tagname), vquery=vquery),
+                               vars=dict(subject=subject.id))
+        if len(results) == 0:
+            return
+
+        subject[tagdef.tagname] = [ res.value for res in self.select_tag_noauthn(subject, tagdef) ]
+
+        if len(self.select_filetags_noauthn(subject, tagdef.tagname)) == 0:
+            self.set_tag(subject, self.tagdefsdict['tags present'], tagdef.tagname)
+
+        self.set_tag_lastmodified(subject, tagdef)
+
     def delete_tag(self, subject, tagdef, value=None):
         wheres = ['tag.subject = $id']
 
@@ -2297,8 +3825,13 @@ class Application (DatabaseConnection):
         if tagdef.writepolicy != 'system':
             # only run extra validation on user-provided values...
             validator = Application.tagnameValidators.get(tagdef.tagname)
+            if validator == None and self.is_subquery_value(value, tagdef):
+                validator = Application.validateSubjectQuery
             if validator:
-                validator(self, value, tagdef, subject)
+                value = validator(self, value, tagdef, subject) or value
+
+            if hasattr(value, 'is_subquery'):
+                return self.set_tag_subquery(subject, tagdef, value)
 
             def convert(v):
                 try:
@@ -3554,10 +5087,27 @@ class Application (DatabaseConnection):
             """Destroy input table created by body1."""
             self.dbquery('DROP TABLE %s' % wraptag(self.input_tablename, '', ''))
 
+        # tags with single-valued sub-query constants, whose cardinality the database checks
+        single_valued_tags = set()
+
         def wrapped_constant(td, v):
             """Return one SQL literal representing values v"""
             param_type = { '': 'boolean', 'bigtext': 'text' }.get(td.dbtype, td.dbtype)
 
+            if type(v) == list and [ x for x in v if hasattr(x, 'is_subquery') ]:
+                # keep sub-query values as SQL sub-selects instead of materializing them here
+                subqueries = [ self.build_subquery_values(x, td) for x in v if hasattr(x, 'is_subquery') ]
+                v = [ x for x in v if not hasattr(x, 'is_subquery') ]
+                if td.multivalue:
+                    return '(%s || %s)' % (wrapped_constant(td, v),
+                                           ' || '.join([ 'ARRAY(%s)::%s[]' % (sq, param_type) for sq in subqueries ]))
+                elif v or len(subqueries) > 1:
+                    raise Conflict(self, 'Tag "%s" cannot take more than one value or sub-query.' % td.tagname)
+                else:
+                    # the database enforces cardinality, see dbquery_single_valued()
+                    single_valued_tags.add(td.tagname)
+                    return '(%s)::%s' % (self.single_valued_subquery(subqueries[0]), param_type)
+
             if v != None:
                 try:
                     if td.multivalue:
@@ -3592,8 +5142,9 @@ class Application (DatabaseConnection):
 
             def insert_tuples(tuples):
                 if tuples:
-                    self.dbquery(('INSERT INTO %(table)s ( %(columns)s ) VALUES ' % dict(table=table,columns=columns))
-                                 + ','.join(tuples))
+                    self.dbquery_single_valued(('INSERT INTO %(table)s ( %(columns)s ) VALUES ' % dict(table=table,columns=columns))
+                                               + ','.join(tuples),
+                                               tagnames=sorted(single_valued_tags))
             
             if hasattr(subject_iter, 'read'):
                 # assume this is the user input stream in CSV format
@@ -3741,7 +5292,7 @@ class Application (DatabaseConnection):
                 assigns = ', '.join([ '%s = %s' % (lhs, rhs) for lhs, rhs in assigns])
                 equery = 'UPDATE %(intable)s AS i SET %(assigns)s FROM ( %(equery)s ) AS e WHERE %(wheres)s' % dict(intable=intable, assigns=assigns, equery=equery, wheres=wheres)
 
-            self.dbquery(equery, evalues)
+            self.dbquery_single_valued(equery, evalues, tagnames=sorted(single_valued_tags))
 
             #self.log('TRACE', 'Application.bulk_update_transact(%s).body3() subjects joined to input' % (self.input_tablename))
 
@@ -3950,7 +5501,7 @@ class Application (DatabaseConnection):
                     web.debug('got exception "%s" peforming body1compensation for %s' % (str(ev), self.input_tablename),
                               traceback.format_exception(et, ev, tb))
 
-    def build_files_by_predlist_path(self, path=None, limit=None, enforce_read_authz=True, tagdefs=None, vprefix='', listas={}, values=None, offset=None, json=False, unnest=None, rangemode=''):
+    def build_files_by_predlist_path(self, path=None, limit=None, enforce_read_authz=True, tagdefs=None, vprefix='', listas={}, values=None, offset=None, json=False, unnest=None, rangemode='', after=None, refctes=None):
         """Build SQL query expression and values map implementing path query.
 
            'path = []'    equivalent to path = [ ([], [], []) ]
@@ -3965,6 +5516,17 @@ class Application (DatabaseConnection):
            'listas'       provides an optional relabeling of list tags (projected result attributes)
 
            Optional args 'values'used for recursive calls, not client calls.
+
+           Top-level calls without 'values' bind the literal predicate
+           values of path, and the LIMIT and OFFSET of the outer query,
+           as parameters named with the optional 'vprefix', so paths of
+           the same shape share one compiled query in
+           compiled_query_cache.  Literals inside sub-query values stay
+           inlined.
+
+           Optional arg 'refctes' collects reference-visibility sub-queries
+           of recursive calls, so that the outermost call can emit each
+           distinct one once as a WITH query shared by the statement.
         """
         if path == None:
             path = self.path
@@ -3978,7 +5540,17 @@ class Application (DatabaseConnection):
         if listas == None:
             listas = dict()
 
-        if not values:
+        parameterized = False
+        if isinstance(values, Values):
+            # recursive call adding to the caller's parameters
+            params = None
+        elif values == None:
+            path, after, params = self.parameterize_querypath(path, tagdefs, after, vprefix)
+            parameterized = True
+            values = Values()
+        else:
+            # caller's parameter map, returned with ours
+            params = dict(values)
             values = Values()
 
         roles = [ r for r in self.context.attributes ]
@@ -3987,6 +5559,9 @@ class Application (DatabaseConnection):
         #rolekeys = ','.join([ '$%s' % values.add(r) for r in roles ])
         rolekeys = ','.join([ wrapval(r, 'text') for r in roles ])
 
+        # older catalogs lack the access index and test the ACL tags instead
+        access_index = subject_access_supported(self.db, self.catalog_id)
+
         prohibited = set(listas.itervalues()).intersection(set(['id', 'readok', 'writeok', 'txid', 'owner']))
         if len(prohibited) > 0:
             raise BadRequest(self, 'Use of %s as list tag alias is prohibited.' % ', '.join(['"%s"' % t for t in prohibited]))
@@ -3997,9 +5572,57 @@ class Application (DatabaseConnection):
 
         if rangemode == '':
             rangemode = self.queryopts.get('range', None)
-            if rangemode not in [ 'values', 'count', 'values<', 'values>' ]:
+            if rangemode not in [ 'values', 'count', 'values<', 'values>', 'facets' ]:
                 rangemode = None
 
+        approximate = None
+        if rangemode != None and self.queryopts.has_key('approximate'):
+            # sample percentage, or 'auto' to size samples from table statistics
+            approximate = self.queryopts['approximate']
+            if approximate:
+                try:
+                    approximate = float(approximate)
+                except ValueError:
+                    approximate = None
+                if approximate == None or approximate <= 0 or approximate > 100:
+                    raise BadRequest(self, 'Query option "approximate" must be a sample percentage greater than 0 and at most 100.')
+            else:
+                approximate = 'auto'
+
+        if refctes == None:
+            # map of reference-visibility query -> WITH query name for this statement
+            refctes = OrderedDict()
+            refctes_owner = True
+            cachekey = self.compiled_query_key(path, limit, enforce_read_authz, tagdefs, vprefix, listas, parameterized, offset, json, unnest, (rangemode, approximate), after)
+        else:
+            # names in our result are only bound by the caller's WITH clause
+            refctes_owner = False
+            cachekey = None
+
+        # (parameter name, tagdef) of each sampled range, whose percentage is bound on every call
+        samples = []
+
+        def sample_percent(tagdef):
+            """Return SQL for the TABLESAMPLE percentage of tagdef's table."""
+            percent = self.range_sample_percent(tagdef, approximate)
+            if not parameterized:
+                return wrapval(percent, 'float8')
+            name = '%ssample%d' % (vprefix, len(samples))
+            samples.append( (name, tagdef) )
+            params[name] = percent
+            return '$%s::float8' % name
+
+        if cachekey:
+            cached = compiled_query_cache.get(cachekey)
+            if cached:
+                cq, cvalues, samples = cached
+                cvalues = dict(cvalues)
+                cvalues.update(params)
+                for name, tagdef in samples:
+                    # 'auto' percentages follow the table statistics, so recompute them
+                    cvalues[name] = self.range_sample_percent(tagdef, approximate)
+                return (cq, cvalues)
+
         def tag_query(tagdef, preds, values, final=True, tprefix='_', spred=False, scalar_subj=None):
             """Compile preds for one tag into a query fetching all satisfactory triples.
 
@@ -4038,12 +5661,19 @@ class Application (DatabaseConnection):
                 if enforce_read_authz:
                     # subjects are already filtered by elem_query() and all visible subjects are readok=True...
                     m['table'] = '(SELECT subject, True AS value FROM resources) t'
+                elif scalar_subj and access_index:
+                    m['table'] = ('(SELECT %s,' % scalar_subj
+                                  + ' (SELECT bool_or(readok) FROM "subject role access" WHERE subject = %s AND role IN (%s))' % (scalar_subj, rolekeys)
+                                  + ' AS value) t')
                 elif scalar_subj:
                     m['table'] = ('(SELECT %s,' % scalar_subj
                                   + ' (SELECT value IN (%s) FROM _owner WHERE subject = %s)' % (rolekeys, scalar_subj)
                                   + ' OR '
                                   + ' (SELECT bool_or(value IN (%s)) FROM "_read users" WHERE subject = %s GROUP BY subject)' % (rolekeys, scalar_subj)
                                   + ' AS value) t')
+                elif access_index:
+                    m['table'] = ('(SELECT DISTINCT subject, True AS value'
+                                  + ' FROM "subject role access" WHERE role IN (%s) AND readok) t' % rolekeys)
                 else:
                     m['table'] = ('(SELECT subject, True AS value'
                                   + ' FROM (SELECT subject FROM _owner WHERE value IN (%s)) o' % rolekeys
@@ -4052,12 +5682,19 @@ class Application (DatabaseConnection):
                 valcol = 'value'
                 m['value'] = ', value' 
             elif tagdef.tagname == 'writeok':
-                if scalar_subj:
+                if scalar_subj and access_index:
+                    m['table'] = ('(SELECT %s,' % scalar_subj
+                                  + ' (SELECT bool_or(writeok) FROM "subject role access" WHERE subject = %s AND role IN (%s))' % (scalar_subj, rolekeys)
+                                  + ' AS value) t')
+                elif scalar_subj:
                     m['table'] = ('(SELECT %s,' % scalar_subj
                                   + ' (SELECT value IN (%s) FROM _owner WHERE subject = %s)' % (rolekeys, scalar_subj)
                                   + ' OR '
                                   + ' (SELECT bool_or(value IN (%s)) FROM "_write users" WHERE subject = %s GROUP BY subject)' % (rolekeys, scalar_subj)
                                   + ' AS value) t')
+                elif access_index:
+                    m['table'] = ('(SELECT DISTINCT subject, True AS value'
+                                  + ' FROM "subject role access" WHERE role IN (%s) AND writeok) t' % rolekeys)
                 else:
                     m['table'] = ('(SELECT subject, True AS value'
                                   + ' FROM (SELECT subject FROM _owner WHERE value IN (%s)) o' % rolekeys
@@ -4092,7 +5729,7 @@ class Application (DatabaseConnection):
                     refpreds.append( web.Storage(tag='owner', op='=', vals=list(roles)) )
                 if reftagdef.multivalue:
                     refvalcol = 'unnest(%s)' % refvalcol
-                refquery = "SELECT %s FROM (%s) s" % (
+                refquery = "SELECT %s AS value FROM (%s) s" % (
                     refvalcol,
                     self.build_files_by_predlist_path([ (refpreds,
                                                          [web.Storage(tag=tagdef.tagref, op=None, vals=[])],
@@ -4100,9 +5737,15 @@ class Application (DatabaseConnection):
                                                       enforce_read_authz=enforce_read_authz,
                                                       values=values,
                                                       tagdefs=tagdefs,
-                                                      rangemode=None)[0]
+                                                      rangemode=None,
+                                                      refctes=refctes)[0]
                     )
-                inner_wheres_proto.append( '%s IN (%s)' % (valcol, refquery) )
+                # identical visibility tests of other tags referencing the same tag share one WITH query
+                refname = refctes.get(refquery)
+                if refname == None:
+                    refname = wraptag('tagref visible %d' % len(refctes), prefix='')
+                    refctes[refquery] = refname
+                inner_wheres_proto.append( '%s IN (SELECT value FROM %s)' % (valcol, refname) )
 
             if scalar_subj:
                 inner_wheres_proto.append( 'subject = %s' % scalar_subj )
@@ -4117,6 +5760,8 @@ class Application (DatabaseConnection):
                         # need to add subject ownership test that is more strict than baseline subject readok enforcement
                         if scalar_subj:
                             inner_wheres_proto.append( 'r.is_owner' )
+                        elif access_index:
+                            inner_wheres_proto.append( 'EXISTS (SELECT 1 FROM "subject role access" a WHERE a.subject = t.subject AND a.role IN (%s) AND a.isowner)' % rolekeys )
                         else:
                             inner_wheres_proto.append( '(SELECT value IN (%s) FROM _owner o WHERE o.subject = t.subject)' % rolekeys )
 
@@ -4140,22 +5785,7 @@ class Application (DatabaseConnection):
                         raise Conflict(self, 'Operator "%s" not supported for tag "%s".' % (pred.op, tagdef.tagname))
 
                     def vq_compile(ast):
-                        """Compile a querypath supplied as a predicate value into a SQL sub-query."""
-                        path = [ x for x in ast.path ]
-                        spreds, lpreds, otags = path[-1]
-                        lpreds = [ x for x in lpreds ]
-                        
-                        projtag = tagdef.tagref
-                        if projtag:
-                            lpreds.append( web.Storage(tag=projtag, op=None, vals=[]) )
-                        elif tagdef.tagname == 'id':
-                            projtag = 'id'
-                        else:
-                            raise BadRequest(self, 'Subquery as predicate value not supported for tag "%s".' % tagdef.tagname)
-                        
-                        path[-1] = (spreds, lpreds, [])
-                        vq, vqvalues = self.build_files_by_predlist_path(path, values=values)
-                        return 'SELECT %s FROM (%s) AS sq' % (wraptag(projtag, prefix=''), vq)
+                        return self.build_subquery_values(ast, tagdef, values=values, tagdefs=tagdefs)
                         
                     try:
                         vals = [ wrapval(v, tagdef.dbtype, range_extensions=True) 
@@ -4267,7 +5897,14 @@ class Application (DatabaseConnection):
                     if len([ p for p in preds if p.op]) != 0:
                         raise BadRequest(self, 'Tag "%s" cannot be filtered in a list-predicate.' % tag)
 
-            if enforce_read_authz:
+            if enforce_read_authz and access_index:
+                # restrict root resources to those visible to some client role via indexed probes of the trigger-maintained access index
+                inner = [ ('(SELECT s.subject AS subject,'
+                           + ' EXISTS (SELECT 1 FROM "subject role access" a WHERE a.subject = s.subject AND a.role IN (%s) AND a.isowner) AS is_owner' % rolekeys
+                           + ' FROM resources s'
+                           + ' WHERE EXISTS (SELECT 1 FROM "subject role access" a WHERE a.subject = s.subject AND a.role IN (%s) AND a.readok)) r' % rolekeys) ]
+
+            elif enforce_read_authz:
                 # remodel root resources with authz status in a way that postgres optimizes better
                 inner = [ 'resources r' ]
                 inner.append( '(SELECT subject FROM _owner WHERE value IN (%s)) is_owner USING (subject)' % rolekeys )
@@ -4283,8 +5920,7 @@ class Application (DatabaseConnection):
                            + ' LEFT OUTER JOIN '.join(inner)
                            + ') r') ]
 
-                if enforce_read_authz:
-                    subject_wheres.append('(r.is_owner OR r.is_reader)')
+                subject_wheres.append('(r.is_owner OR r.is_reader)')
 
             else:
                 inner = [ 'resources r' ]
@@ -4314,6 +5950,10 @@ class Application (DatabaseConnection):
                     if tag == 'id':
                         range_column = 'subject'
                         range_table = 'resources'
+                    elif tag in [ 'readok', 'writeok' ] and access_index:
+                        range_table = ('resources LEFT OUTER JOIN (SELECT subject, bool_or(%s) AS ok FROM "subject role access"' % tag
+                                       + ' WHERE role IN (%s) GROUP BY subject) acl USING (subject)' % rolekeys)
+                        range_column = 'coalesce(acl.ok, False)'
                     elif tag in [ 'readok', 'writeok' ]:
                         acl = dict(readok='read', writeok='write')[tag]
                         range_table = 'resources LEFT OUTER JOIN "_%s users" acl USING (subject) LEFT OUTER JOIN "_owner" o USING (subject)' % acl
@@ -4339,6 +5979,7 @@ class Application (DatabaseConnection):
                             raise BadRequest(self, 'Operator ":absent:" not supported in projection list predicates.')
 
                 if final:
+                    exprjson = False
                     if rangemode == None:
                         # returning triple values per subject
                         if lq:
@@ -4352,6 +5993,26 @@ class Application (DatabaseConnection):
                                 expr = '%s.value' % wraptag(td.tagname, prefix=tprefix)
                             else:
                                 expr = '%s.subject IS NOT NULL' % wraptag(td.tagname, prefix=tprefix)
+                    elif approximate and td.dbtype != '' and tag not in [ 'id', 'readok', 'writeok' ]:
+                        # returning estimates from a block sample of the tag table as a JSON object
+                        expr = self.range_sample_expr(td, rangemode, sample_percent, limit)
+                        exprjson = True
+                    elif rangemode == 'facets':
+                        # returning histogram of subject counts per value as a JSON array, sharing the resources CTE with other facets
+                        if tag in [ 'readok', 'writeok' ]:
+                            facet_table = '(SELECT bool_or(%s) AS value FROM %s GROUP BY subject) AS a' % (range_column, range_table)
+                        elif td.dbtype == '':
+                            facet_table = ('(SELECT %(table)s.subject IS NOT NULL AS value FROM resources LEFT OUTER JOIN %(table)s USING (subject)) AS a'
+                                           % dict(table=wraptag(td.tagname)))
+                        else:
+                            facet_table = '(SELECT %s AS value FROM %s) AS a' % (range_column, range_table)
+                        expr = ("(SELECT '[' || coalesce(array_to_string(array_agg(jsonobj(ARRAY["
+                                "jsonfield('value', val2json(value)), jsonfield('count', val2json(count))"
+                                "]) ORDER BY count DESC, value), ','), '') || ']' "
+                                'FROM (SELECT value, count(*) AS count FROM %(table)s GROUP BY value ORDER BY count DESC, value %(limit)s) AS t)'
+                                % dict(table=facet_table,
+                                       limit=({ True: 'LIMIT %d' % (limit != None and limit or 0), False: ''}[limit != None])))
+                        exprjson = True
                     elif rangemode == 'values':
                         # returning distinct values across all subjects
                         expr = '(SELECT array_agg(DISTINCT %s) FROM %s)' % (range_column, range_table)
@@ -4376,7 +6037,9 @@ class Application (DatabaseConnection):
                                        limit=({ True: 'LIMIT %d' % (limit != None and limit or 0), False: ''}[limit != None]))
                                 )
                     otagexprs[listas.get(td.tagname, td.tagname)] = expr
-                    if json:
+                    if json and exprjson:
+                        selects.append('jsonfield(%s, %s)' % (wrapval(listas.get(td.tagname, td.tagname)), expr))
+                    elif json:
                         try:
                             selects.append('jsonfield(%s, val2json(%s))' % (wrapval(listas.get(td.tagname, td.tagname)), expr))
                         except ValueError, e:
@@ -4390,6 +6053,22 @@ class Application (DatabaseConnection):
             if not final:
                 selects.append( '(%s) AS context' % ' UNION '.join([ 'SELECT * FROM %s s' % sq for sq in finals ]) )
 
+            pageselects = []
+            if after != None and final and rangemode == None:
+                # keyset pagination orders by otags with subject id as tie-breaker
+                keyexprs = []
+                for t, dir in otags:
+                    td = tagdefs[t]
+                    if td.multivalue:
+                        raise BadRequest(self, 'Multivalue tag "%s" cannot order a keyset paged query.' % t)
+                    keyexprs.append( (otagexprs[listas.get(t, t)], dir, td.dbtype or 'boolean') )
+                keyexprs.append( ('r.subject', None, 'int8') )
+                if after.keys != None:
+                    subject_wheres.append(keyset_where(keyexprs, after.keys + [ after.id ]))
+                pageselects = [ '%s AS %s' % (expr, wraptag('page key %d' % i, prefix=''))
+                                for i, (expr, dir, dbtype) in enumerate(keyexprs[0:-1]) ]
+                pageselects.append( 'r.subject AS "page id"' )
+
             if subject_wheres:
                 where = 'WHERE ' + ' AND '.join([ '(%s)' % w for w in subject_wheres ])
             else:
@@ -4400,9 +6079,17 @@ class Application (DatabaseConnection):
             tables = ' LEFT OUTER JOIN '.join(tables)
 
             if otags and final:
-                order = ' ORDER BY %s' % ', '.join([ '%s %s NULLS LAST' % (otagexprs[listas.get(t, t)],
-                                                                           { ':asc:': 'ASC', ':desc:': 'DESC', None: 'ASC'}[dir])
-                                                     for t, dir in otags])
+                order = [ '%s %s NULLS LAST' % (otagexprs[listas.get(t, t)],
+                                                { ':asc:': 'ASC', ':desc:': 'DESC', None: 'ASC'}[dir])
+                          for t, dir in otags ]
+            else:
+                order = []
+
+            if pageselects:
+                order.append('r.subject')
+
+            if order:
+                order = ' ORDER BY %s' % ', '.join(order)
             else:
                 order = ''
 
@@ -4412,6 +6099,9 @@ class Application (DatabaseConnection):
                 if final and json:
                     selects = 'jsonobj(ARRAY[%s]) AS json' % selects
 
+                if pageselects:
+                    selects = ', '.join([ selects ] + pageselects)
+
                 q = ('SELECT %(selects)s FROM %(tables)s %(where)s %(order)s' 
                      % dict(selects=selects,
                             tables=tables,
@@ -4457,10 +6147,26 @@ class Application (DatabaseConnection):
             cq = elem_query(spreds, lpreds, values, i==len(path)-1, otags=ordertags)
 
         if limit and rangemode == None:
-            cq += ' LIMIT %d' % limit
+            if parameterized:
+                params['%slimit' % vprefix] = limit
+                cq += ' LIMIT $%slimit' % vprefix
+            else:
+                cq += ' LIMIT %d' % limit
 
         if offset and rangemode == None:
-            cq += ' OFFSET %d' % offset
+            if parameterized:
+                params['%soffset' % vprefix] = offset
+                cq += ' OFFSET $%soffset' % vprefix
+            else:
+                cq += ' OFFSET %d' % offset
+
+        if refctes_owner and refctes:
+            # nested sub-queries were registered before their users, so this order satisfies dependencies
+            ctes = ', '.join([ '%s AS (%s)' % (name, query) for query, name in refctes.items() ])
+            if cq.startswith('WITH '):
+                cq = 'WITH %s, %s' % (ctes, cq[len('WITH '):])
+            else:
+                cq = 'WITH %s %s' % (ctes, cq)
 
         def dbquote(s):
             return s.replace("'", "''")
@@ -4468,7 +6174,172 @@ class Application (DatabaseConnection):
         #traceInChunks(cq)
         #web.debug('values', values.pack())
 
-        return (cq, values.pack())
+        if cachekey:
+            compiled_query_cache.put(cachekey, (cq, values.pack(), samples))
+
+        values = values.pack()
+        if params:
+            values.update(params)
+
+        return (cq, values)
+
+    def range_sample_percent(self, tagdef, approximate):
+        """Return TABLESAMPLE percentage for tagdef's table, sizing 'auto' samples from pg_class statistics."""
+        if approximate != 'auto':
+            return approximate
+        target = getParamEnv('range sample rows', Application.range_sample_rows)
+        results = self.dbquery('SELECT reltuples FROM pg_catalog.pg_class WHERE relname = $relname',
+                               vars=dict(relname='_' + tagdef.tagname))
+        if len(results) == 0 or results[0].reltuples <= target:
+            return 100.0
+        return max(0.0001, 100.0 * target / results[0].reltuples)
+
+    def tablesample_supported(self):
+        """Return True if the database server supports TABLESAMPLE, added in PostgreSQL 9.5."""
+        return self.db._db_cursor().connection.server_version >= 90500
+
+    def range_sample_expr(self, tagdef, rangemode, sample_percent, limit):
+        """Compile an approximate range expression returning a JSON object text.
+
+           Triples are sampled with TABLESAMPLE SYSTEM, at the percentage
+           whose SQL sample_percent(tagdef) returns, and restricted to
+           the visible 'resources' of the range query.  Servers without
+           TABLESAMPLE scan the whole table instead, with sample fraction
+           1.  Estimates assume values are not clustered by table block:
+
+           count    -- {"estimate", "lower", "upper", "sample fraction"} using the
+                       Haas-Stokes Duj1 estimator also used by ANALYZE; lower is
+                       the distinct count seen, upper adds every unsampled triple
+
+           values   -- {"values", "sample fraction"} with the values seen, a subset
+
+           values<, values>, or facets
+                    -- {"values": [ {"value", "estimate", "error"}... ], "sample fraction"}
+                       with estimated counts and 95% error margins
+        """
+        if self.tablesample_supported():
+            percent = sample_percent(tagdef)
+            fraction = '(%s / 100.0)' % percent
+            tablesample = ' TABLESAMPLE SYSTEM (%s)' % percent
+        else:
+            fraction = wrapval(1.0, 'float8')
+            tablesample = ''
+        sample = ('(SELECT %(table)s.value AS value FROM %(table)s%(tablesample)s JOIN resources USING (subject)) AS sample'
+                  % dict(table=wraptag(tagdef.tagname), tablesample=tablesample))
+        freqs = '(SELECT value, count(*) AS c FROM %s GROUP BY value) AS f' % sample
+        fractionfield = "jsonfield('sample fraction', val2json(%s))" % fraction
+
+        if rangemode == 'count':
+            return ('(SELECT jsonobj(ARRAY['
+                    "jsonfield('estimate', val2json(CASE WHEN n = 0 THEN 0"
+                    ' ELSE round(least(n / %(q)s, greatest(d, n * d / (n - f1 + f1 * %(q)s))))::int8 END)), '
+                    "jsonfield('lower', val2json(d)), "
+                    "jsonfield('upper', val2json(round(d + n / %(q)s - n)::int8)), "
+                    '%(fraction)s]) '
+                    'FROM (SELECT coalesce(sum(c), 0)::float8 AS n, count(*)::int8 AS d, '
+                    'coalesce(sum(CASE WHEN c = 1 THEN 1 ELSE 0 END), 0)::float8 AS f1 FROM %(freqs)s) AS s)'
+                    % dict(q=fraction, fraction=fractionfield, freqs=freqs))
+        elif rangemode == 'values':
+            return ("(SELECT jsonobj(ARRAY[jsonfield('values', val2json(array_agg(value))), %(fraction)s]) FROM %(freqs)s)"
+                    % dict(fraction=fractionfield, freqs=freqs))
+        else:
+            if rangemode[-1] == '<':
+                freqorder = 'ASC'
+            else:
+                freqorder = 'DESC'
+            return ("(SELECT jsonobj(ARRAY[jsonfield('values', "
+                    "'[' || coalesce(array_to_string(array_agg(jsonobj(ARRAY["
+                    "jsonfield('value', val2json(value)), "
+                    "jsonfield('estimate', val2json(round(c / %(q)s)::int8)), "
+                    "jsonfield('error', val2json(round(1.96 * sqrt(c * (1 - %(q)s)) / %(q)s)::int8))"
+                    "]) ORDER BY c %(order)s, value), ','), '') || ']'), %(fraction)s]) "
+                    'FROM (SELECT value, c FROM %(freqs)s ORDER BY c %(order)s, value %(limit)s) AS t)'
+                    % dict(q=fraction, fraction=fractionfield, freqs=freqs, order=freqorder,
+                           limit=({ True: 'LIMIT %d' % (limit != None and limit or 0), False: ''}[limit != None])))
+
+    def compiled_query_key(self, path, limit, enforce_read_authz, tagdefs, vprefix, listas, parameterized, offset, json, unnest, rangemode, after=None):
+        """Return compiled_query_cache key for a build_files_by_predlist_path call or None if not cacheable.
+
+           Only parameterized top-level compiles against the request
+           tagdefs or the static tagdefs are cached, keyed by the path
+           shape with QueryParam placeholders in place of literals.
+           Paths using 'subject text' are not, since compiling them
+           refreshes the text index.
+        """
+        if not parameterized:
+            return None
+
+        if tagdefs is self.tagdefsdict and hasattr(self, 'tagdefs_txid'):
+            tagdefs_version = self.tagdefs_txid
+        elif tagdefs is Application.static_tagdefs:
+            tagdefs_version = 'static'
+        else:
+            return None
+
+        tags = set()
+        pathkey = querypath_key(path, tags)
+        if 'subject text' in tags:
+            return None
+
+        if rangemode[0] == None:
+            # outer LIMIT and OFFSET are parameters
+            limit = bool(limit)
+            offset = bool(offset)
+
+        return (self.catalog_id,
+                tagdefs_version,
+                frozenset(self.context.attributes),
+                pathkey,
+                querypath_key(listas),
+                vprefix, limit, offset, enforce_read_authz, json, unnest, rangemode,
+                after and (tuple(after.otags), after.keys != None and querypath_key(after.keys), querypath_key(after.id)))
+
+    def parameterize_querypath(self, path, tagdefs, after=None, vprefix=''):
+        """Return (path, after, params) with literal values replaced by QueryParam placeholders.
+
+           Predicate values which downcast for their tag, and page keys
+           of after, become parameters named with vprefix which params
+           binds.  Other values, such as sub-queries, free-text words,
+           or values failing to downcast, are left for the compiler to
+           inline or reject as before.
+        """
+        params = dict()
+
+        def param(value):
+            if type(value) == tuple:
+                return QueryParam(tuple([ param(v).placeholder for v in value ]))
+            name = '%sp%d' % (vprefix, len(params))
+            params[name] = value
+            return QueryParam('$%s' % name)
+
+        def bind(value, dbtype, range_extensions=False):
+            if value == None or hasattr(value, 'is_subquery'):
+                return value
+            try:
+                return param(bindval(value, dbtype, range_extensions))
+            except ValueError:
+                return value
+
+        def bindpred(pred):
+            tagdef = tagdefs.get(pred.tag)
+            if tagdef == None or not tagdef.dbtype or type(pred.vals) != list \
+                    or pred.op in [ None, ':absent:', 'IN', ':word:', ':!word:' ]:
+                return pred
+            return web.Storage(tag=pred.tag, op=pred.op, vals=[ bind(v, tagdef.dbtype, True) for v in pred.vals ])
+
+        if not path:
+            path = [ ( [], [], [] ) ]
+
+        path = [ ( [ bindpred(p) for p in spreds ], [ bindpred(p) for p in lpreds ], otags )
+                 for spreds, lpreds, otags in path ]
+
+        if after != None and after.keys != None:
+            dbtypes = [ tagdefs.has_key(t) and (tagdefs[t].dbtype or 'boolean') or None for t in after.otags ]
+            after = web.Storage(otags=after.otags,
+                                keys=[ dbtype and bind(key, dbtype) or key for dbtype, key in zip(dbtypes, after.keys) ],
+                                id=bind(after.id, 'int8'))
+
+        return (path, after, params)
 
 
     def build_select_files_by_predlist(self, subjpreds=None, listtags=None, ordertags=[], id=None, qd=0, listas=None, tagdefs=None, enforce_read_authz=True, limit=None, listpreds=None, vprefix=''):
@@ -4505,18 +6376,28 @@ class Application (DatabaseConnection):
         #web.debug('...end query')
         #for r in self.dbquery('EXPLAIN ANALYZE %s' % query, vars=values):
         #    web.debug(r)
-        return self.dbquery(query, vars=values)
+        return self.dbquery_prepared(query, vars=values)
 
-    def select_files_by_predlist_path(self, path=None, limit=None, enforce_read_authz=True, offset=None, json=False):
+    def select_files_by_predlist_path(self, path=None, limit=None, enforce_read_authz=True, offset=None, json=False, after=None):
         #self.txlog('TRACE', value='select_files_by_predlist_path entered')
-        query, values = self.build_files_by_predlist_path(path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json)
+        query, values = self.build_files_by_predlist_path(path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json, after=after)
         #self.txlog('TRACE', value='select_files_by_predlist_path query built')
-        result = self.dbquery(query, values)
+        self.admit_query(query, values)
+        result = self.dbquery_prepared(query, values)
         #self.txlog('TRACE', value='select_files_by_predlist_path exiting')
         return result
 
-    def copyto_csv_files_by_predlist_path(self, outfile, path, limit=None, enforce_read_authz=True, offset=None, json=False):
+    def stream_csv_files_by_predlist_path(self, path, limit=None, enforce_read_authz=True, offset=None, json=False, after=None):
+        """Return StreamedCopy producing CSV for path query compiled now and run when iterated.
+
+           Keyset pagination is refused, since COPY output is streamed
+           after the headers which would have to carry the next page.
+           Like stream_files_by_predlist_path(), the output comes from a
+           newer snapshot than the ETag and is not stored in response_cache.
+        """
         #self.txlog('TRACE', value='select_files_by_predlist_path entered')
+        if after != None:
+            raise BadRequest(self, 'Query option "after" is not supported for text/csv results.')
         spreds, lpreds, otags = path[-1]
         got_cols = set()
         csv_cols = []
@@ -4527,15 +6408,16 @@ class Application (DatabaseConnection):
         csv_cols = ', '.join([ wraptag(tag, '', '') for tag in csv_cols ])
 
         query, values = self.build_files_by_predlist_path(path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json)
+        self.admit_query(query, values)
         query = 'SELECT %s FROM (%s) s' % (csv_cols, query)
 
-        self.db._db_cursor().copy_expert("COPY (%s) TO STDOUT CSV DELIMITER ','" % query,
-                                         outfile)
+        # COPY takes no parameters, so let the driver render the final statement text
+        sql = web.db.reparam(myutf8("COPY (%s) TO STDOUT CSV DELIMITER ','" % query), values)
+        query = self.db._db_cursor().mogrify(sql.query('pyformat'), sql.values())
 
         #self.txlog('TRACE', value='select_files_by_predlist_path query built')
-        result = self.dbquery(query, values)
-        #self.txlog('TRACE', value='select_files_by_predlist_path exiting')
-        return result
+        self.response_cache_key = None
+        return StreamedCopy(self, query)
 
     def update_subject_text_tsv(self):
         """Find stale subjects and update their "subject text" tsv value to latest graph content.
@@ -4564,11 +6446,76 @@ class Application (DatabaseConnection):
 
         self.set_tag_lastmodified(None, self.tagdefsdict['subject text'])
 
+    def build_subquery_values(self, ast, tagdef, values=None, tagdefs=None):
+        """Compile a querypath supplied as a value of tagdef into a SQL sub-query projecting one value column.
+
+           The values are the referenced tag of a tagref tagdef or the
+           subject id of the 'id' tag, so they can be used in
+           predicates and writes without leaving the database.
+        """
+        path = [ x for x in ast.path ]
+        spreds, lpreds, otags = path[-1]
+        lpreds = [ x for x in lpreds ]
+
+        projtag = tagdef.tagref
+        if projtag:
+            lpreds.append( web.Storage(tag=projtag, op=None, vals=[]) )
+        elif tagdef.tagname == 'id':
+            projtag = 'id'
+        else:
+            raise BadRequest(self, 'Subquery as value not supported for tag "%s".' % tagdef.tagname)
+
+        path[-1] = (spreds, lpreds, [])
+        if values == None:
+            # our caller embeds the sub-query text without parameters, so keep its literals inlined
+            values = Values()
+        vq, vqvalues = self.build_files_by_predlist_path(path, values=values, tagdefs=tagdefs)
+        return 'SELECT %s FROM (%s) AS sq' % (wraptag(projtag, prefix=''), vq)
+
     def select_predlist_path_txid(self, path=None, limit=None, enforce_read_authz=True):
         """Determine last-modified txid for query path dataset, optionally testing previous txid as shortcut.
 
            The value prev_txid is trusted to be an accurate value, if it is provided.
         """
+        txid = self.memory_predlist_path_txid(path)
+        if txid != None:
+            return txid
+        query, values = self.build_predlist_path_txid(path)
+        return self.dbquery(query, vars=values)[0].txid
+
+    def predlist_path_relevant_tags(self, path):
+        """Find the relevant tags involved in computing a query path result."""
+        tags = set(['owner', 'read users'])
+        for elem in path:
+            spreds, lpreds, otags = elem
+            if not spreds:
+                # without tag constraints, we have an implicit result set defined by the resources table a.k.a. 'id' tag
+                tags.add('id')
+            tags.update(set([ p.tag for p in spreds + lpreds ] + [ o[0] for o in otags ]))
+            for vals in [ p.vals for p in (spreds + lpreds) if p.vals ]:
+                for v in vals:
+                    if hasattr(v, 'is_subquery'):
+                        tags.update(self.predlist_path_relevant_tags(v.path))
+        return tags
+
+    def memory_predlist_path_txid(self, path=None):
+        """Compute last-modified txid for query path dataset from tag_txid_cache, or None if unavailable.
+
+           Only tagdefs visible to the client count, as in the query
+           compiled by build_predlist_path_txid().
+        """
+        if getattr(self, 'tags_version', None) == None:
+            return None
+        if not path:
+            path = [ ( [], [], [] ) ]
+        txids = tag_txid_cache.select(self.db, self.catalog_id, self.tags_version)
+        txids = [ txids[t] for t in self.predlist_path_relevant_tags(path) if t in self.tagdefsdict and t in txids ]
+        if txids:
+            return max(txids)
+        return None
+
+    def build_predlist_path_txid(self, path=None):
+        """Compile (query, values) finding last-modified txid for query path dataset as scalar "txid" column."""
         if not path:
             path = [ ( [], [], [] ) ]
 
@@ -4593,34 +6540,69 @@ class Application (DatabaseConnection):
                the tag-last-modified time of the 'owner' tag if
                nothing else.
             """
-            
-            def relevant_tags(path):
-                """Find the relevant tags involved in computing a query path result."""
-                tags = set(['owner', 'read users'])
-                for elem in path:
-                    spreds, lpreds, otags = elem
-                    if not spreds:
-                        # without tag constraints, we have an implicit result set defined by the resources table a.k.a. 'id' tag
-                        tags.add('id')
-                    tags.update(set([ p.tag for p in spreds + lpreds ] + [ o[0] for o in otags ]))
-                    for vals in [ p.vals for p in (spreds + lpreds) if p.vals ]:
-                        for v in vals:
-                            if hasattr(v, 'is_subquery'):
-                                tags.update(relevant_tags(v.path))
-                return tags
-
-            tags = relevant_tags(path)
+            tags = self.predlist_path_relevant_tags(path)
             #web.debug('relevant tags', tags)
             
             path = [ ( [ web.Storage(tag='tagdef', op='=', vals=[ t for t in tags ]) ],
                        [ web.Storage(tag='tag last modified txid', op=None, vals=[]) ],
                        [] ) ]
-            query, values = self.build_files_by_predlist_path(path)
+            query, values = self.build_files_by_predlist_path(path, rangemode=None, vprefix='txid_')
             query = 'SELECT max("tag last modified txid") AS txid FROM (%s) AS sq' % query
-            return self.dbquery(query, vars=values)[0].txid
+            return (query, values)
 
         return relevant_tags_txid(path)
 
+    def select_files_by_predlist_path_txid(self, path=None, limit=None, enforce_read_authz=True, offset=None, json=False, after=None):
+        """Return (txid, results) for query path, fetching the dataset txid in the same statement as the results.
+
+           The txid rides along as an extra "etag txid" column which
+           is stripped from the result rows.  An empty result carries
+           no txid, so only then is the txid query run separately.
+        """
+        txid = self.memory_predlist_path_txid(path)
+        if txid != None:
+            return (txid, self.select_files_by_predlist_path(path=path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json, after=after))
+
+        tquery, tvalues = self.build_predlist_path_txid(path)
+        query, values = self.build_files_by_predlist_path(path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json, after=after)
+        self.admit_query(query, values)
+
+        if set(tvalues).intersection(set(values)):
+            # independently compiled parameter names collide, so fall back to two statements
+            return (self.dbquery(tquery, vars=tvalues)[0].txid,
+                    self.dbquery_prepared(query, values))
+
+        values = dict(values)
+        values.update(tvalues)
+        query = 'SELECT r.*, (%s) AS "etag txid" FROM (%s) AS r' % (tquery, query)
+
+        results = list(self.dbquery_prepared(query, values))
+        if results:
+            txid = results[0]['etag txid']
+            for res in results:
+                del res['etag txid']
+        else:
+            txid = self.dbquery(tquery, vars=tvalues)[0].txid
+
+        return (txid, results)
+
+    def select_files_by_predlist_path_etag(self, path=None, limit=None, enforce_read_authz=True, offset=None, json=False, after=None):
+        """Set HTTP ETag for query path dataset and return its results, or None if client's cached copy is current.
+
+           Conditional requests still test the txid before running
+           the main query so the 304 Not Modified case stays cheap;
+           unconditional requests get results and txid in one round trip.
+        """
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH'):
+            self.set_http_etag(txid=self.select_predlist_path_txid(path, limit=limit, enforce_read_authz=enforce_read_authz))
+            if self.http_is_cached():
+                return None
+            return self.select_files_by_predlist_path(path=path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json, after=after)
+
+        txid, results = self.select_files_by_predlist_path_txid(path=path, limit=limit, enforce_read_authz=enforce_read_authz, offset=offset, json=json, after=after)
+        self.set_http_etag(txid=txid)
+        return results
+
     def prepare_path_query(self, path, list_priority=['path', 'list', 'view', 'subject', 'default'], extra_tags=[]):
         """Prepare (path, listtags, writetags, limit) from input path, web environment, and input policies.
 
@@ -4635,6 +6617,9 @@ class Application (DatabaseConnection):
 
            extra_tags  -- tags to add to listpreds of path[-1] without adding to listtags or writetags."""
 
+        # path queries of this request now come from the client, so are subject to admit_query()
+        self.query_admission = True
+
         if not path:
             path = [ ( [], [], [] ) ]
         else:
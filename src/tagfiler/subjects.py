@@ -28,22 +28,62 @@ import sys
 import time
 import datetime
 import pytz
+import threading
+import itertools
+from collections import OrderedDict
 
-from dataserv_app import Application, NotFound, BadRequest, Conflict, RuntimeError, Forbidden, urlquote, urlunquote, parseBoolString, predlist_linearize, path_linearize, wraptag, jsonFileReader, jsonArrayFileReader, JSONArrayError, jsonWriter, getParamEnv, make_temporary_file, yieldBytes
+from dataserv_app import Application, NotFound, BadRequest, Conflict, RuntimeError, Forbidden, urlquote, urlunquote, parseBoolString, predlist_linearize, path_linearize, wraptag, jsonFileReader, jsonArrayFileReader, JSONArrayError, jsonWriter, getParamEnv, logger, shared_cache, response_cache, StreamedQuery, QueryPlan
 
 myrand = random.Random()
 myrand.seed(os.getpid())
 
 
 class SubjectCache (object):
+    """A bounded LRU of unique subject lookups, partitioned per catalog.
+
+       Each catalog partition holds at most 'subject cache entries' entries
+       and roughly 'subject cache bytes' of subject data, evicting the
+       least recently used entries first.  Entries older than
+       cache_stale_seconds are purged.
+
+       Hits validated within the last 'subject cache grace seconds' are
+       trusted.  Older hits are revalidated together with a batch of other
+       expired entries of the same catalog in one query against "subject
+       last tagged txid", comparing each subject to the snapshot xmin of
+       the transaction which last filled or revalidated the entry.
+    """
 
     purge_interval_seconds = 60
     cache_stale_seconds = 300
+    max_entries = 10000
+    max_bytes = 16 * 1024 * 1024
+    grace_seconds = 2
+    revalidate_batch = 100
 
     def __init__(self):
-        # entries['%s %s' % (role, querypath)] = (ctime, value)
-        self.querypath_entries = dict()
+        # partitions[catalog_id][key] = Storage(ctime, nbytes, value=(subjects, txid), mark, vtime) in LRU order
+        self.partitions = dict()
+        self.partition_bytes = dict()
+        self.lock = threading.Lock()
         self.last_purge_time = None
+        self.stats = dict(hits=0, misses=0, evictions=0, revalidations=0, stale=0)
+
+    def entry_bytes(self, key, subject):
+        return len(key) + sum([ len(unicode(v)) for v in subject.itervalues() if v is not None ])
+
+    def evict(self, catalog_id):
+        entries = self.partitions[catalog_id]
+        max_entries = getParamEnv('subject cache entries', SubjectCache.max_entries)
+        max_bytes = getParamEnv('subject cache bytes', SubjectCache.max_bytes)
+        while entries and (len(entries) > max_entries or self.partition_bytes[catalog_id] > max_bytes):
+            key, entry = entries.popitem(last=False)
+            self.partition_bytes[catalog_id] -= entry.nbytes
+            self.stats['evictions'] += 1
+
+    def discard(self, catalog_id, key):
+        entry = self.partitions.get(catalog_id, {}).pop(key, None)
+        if entry:
+            self.partition_bytes[catalog_id] -= entry.nbytes
 
     def purge(self):
         now = datetime.datetime.now(pytz.timezone('UTC'))
@@ -51,44 +91,147 @@ class SubjectCache (object):
             pass
         else:
             self.last_purge_time = now
-            for item in self.querypath_entries.items():
-                key, entry = item
-                ctime, subject = entry
-                if (now - ctime).seconds > SubjectCache.cache_stale_seconds:
-                    self.querypath_entries.pop(key, None)
+            for catalog_id, entries in self.partitions.items():
+                for key, entry in entries.items():
+                    if (now - entry.ctime).seconds > SubjectCache.cache_stale_seconds:
+                        self.discard(catalog_id, key)
+            if getParamEnv('log subject cache stats', False):
+                logger.info('subject cache: %s entries=%d bytes=%d' % (
+                        ' '.join([ '%s=%d' % item for item in sorted(self.stats.items()) ]),
+                        sum([ len(entries) for entries in self.partitions.values() ]),
+                        sum(self.partition_bytes.values())))
+
+    def get(self, catalog_id, key):
+        self.lock.acquire()
+        try:
+            self.purge()
+            entries = self.partitions.get(catalog_id, {})
+            entry = entries.pop(key, None)
+            if entry:
+                # reinsert as most recently used
+                entries[key] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, catalog_id, key, ctime, value, mark, vtime=None):
+        if vtime == None:
+            vtime = time.time()
+        nbytes = self.entry_bytes(key, value[0][0])
+        self.lock.acquire()
+        try:
+            self.discard(catalog_id, key)
+            self.partitions.setdefault(catalog_id, OrderedDict())[key] = web.Storage(ctime=ctime, nbytes=nbytes, value=value,
+                                                                                     mark=mark, vtime=vtime)
+            self.partition_bytes[catalog_id] = self.partition_bytes.get(catalog_id, 0) + nbytes
+            self.evict(catalog_id)
+        finally:
+            self.lock.release()
+
+    def count(self, stat, n=1):
+        self.lock.acquire()
+        try:
+            self.stats[stat] += n
+        finally:
+            self.lock.release()
 
-    def select(self, db, searchfunc, querypath, role):
-        key = '%s %s' % (role, querypath)
+    def snapshot_mark(self, db):
+        """Return the snapshot xmin of the current transaction of db.
 
-        self.purge()
-        
-        def cached():
-            ctime, subject = self.querypath_entries.get(key, (None, None))
-            if subject:
-                results = db.query('SELECT value AS mtime FROM %s' % wraptag('subject last tagged')
-                                   + ' WHERE subject = $id', vars=dict(id=subject.id))
-                if len(results) == 1:
-                    mtime = results[0].mtime
-                    
-                    if mtime <= ctime:
-                        return subject
-                        
-                self.querypath_entries.pop(key, None)
-
-            return None
-
-        cached_subject = cached()
-
-        if cached_subject:
-            return [ cached_subject ]
+           It must come from the transaction that fills an entry, since a
+           mark observed by another transaction may be newer than the
+           snapshot the entry was actually read from.
+        """
+        return db.query('SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin')[0].xmin
+
+    def revalidate(self, db, catalog_id, key):
+        """Revalidate key and other expired entries of catalog in one query.
+
+           Returns True if the entry for key is still fresh.
+        """
+        grace = getParamEnv('subject cache grace seconds', SubjectCache.grace_seconds)
+        limit = getParamEnv('subject cache revalidate batch', SubjectCache.revalidate_batch)
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            entries = self.partitions.get(catalog_id, {})
+            if key not in entries:
+                # evicted by a concurrent request
+                return False
+            batch = [ (key, entries[key]) ]
+            # least recently used entries are visited first
+            for k, entry in itertools.islice(entries.iteritems(), 4 * limit):
+                if len(batch) >= limit:
+                    break
+                if k != key and (now - entry.vtime) > grace:
+                    batch.append( (k, entry) )
+        finally:
+            self.lock.release()
+
+        ids = set([ entry.value[0][0].id for k, entry in batch ])
+        results = db.query('SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin,'
+                           + ' array_agg(subject) AS subjects, array_agg(value) AS txids'
+                           + ' FROM %s' % wraptag('subject last tagged txid')
+                           + ' WHERE subject IN (%s)' % ','.join([ '%d' % id for id in ids ]))[0]
+        txids = dict(zip(results.subjects or [], results.txids or []))
+
+        fresh = False
+        stale = 0
+        self.lock.acquire()
+        try:
+            for k, entry in batch:
+                txid = txids.get(entry.value[0][0].id)
+                if txid == None or txid >= entry.mark:
+                    # subject is gone or possibly modified since entry was filled
+                    self.discard(catalog_id, k)
+                    stale += 1
+                else:
+                    entry.mark = results.xmin
+                    entry.vtime = now
+                    if k == key:
+                        fresh = True
+            self.stats['revalidations'] += len(batch)
+            self.stats['stale'] += stale
+        finally:
+            self.lock.release()
+
+        return fresh
+
+    def select(self, db, searchfunc, querypath, role, catalog_id, flags=()):
+        """Return (subjects, txid) for querypath as seen by role, via searchfunc() on a miss.
+
+           The flags which alter what searchfunc() returns, e.g. whether
+           read authz is enforced, are part of the key so that lookups
+           made with different flags never share an entry.
+        """
+        key = '%s %s %s' % (role, ','.join([ '%d' % bool(f) for f in flags ]), querypath)
+        grace = getParamEnv('subject cache grace seconds', SubjectCache.grace_seconds)
+
+        entry = self.get(catalog_id, key)
+        if entry == None:
+            # adopt an entry resolved by another worker process, always revalidating it
+            shared = shared_cache.get(('subject', catalog_id, key))
+            if shared:
+                ctime, value, mark = shared
+                self.put(catalog_id, key, ctime, value, mark, vtime=0)
+                entry = self.get(catalog_id, key)
+
+        if entry and ((time.time() - entry.vtime) <= grace or self.revalidate(db, catalog_id, key)):
+            self.count('hits')
+            return entry.value
         else:
+            self.count('misses')
             ctime = datetime.datetime.now(pytz.timezone('UTC'))
-            subjects = searchfunc()
+            # read before searchfunc() so the mark is never newer than the snapshot it uses
+            mark = self.snapshot_mark(db)
+            value = searchfunc()
 
-            if len(subjects) == 1:
-                self.querypath_entries[key] = (ctime, subjects[0])
+            if len(value[0]) == 1:
+                self.put(catalog_id, key, ctime, value, mark)
+                shared_cache.put(('subject', catalog_id, key), None, (ctime, value, mark))
 
-            return subjects
+            return value
 
 subject_cache = SubjectCache()
 
@@ -138,7 +281,8 @@ class Subject (Node):
         self.unique = self.validate_subjpreds_unique(subjpreds=subjpreds)
         
         if self.unique != None:
-            self.subjects, self.path_txid = subject_cache.select(self.db, searchfunc, path_linearize(self.path), self.context.client)
+            self.subjects, self.path_txid = subject_cache.select(self.db, searchfunc, path_linearize(self.path), self.context.client, self.catalog_id,
+                                                                 flags=(enforce_read_authz, allow_blank, allow_multiple, enforce_parent))
             self.subject = self.subjects[0]
             self.datapred, self.dataid, self.dataname, self.dtype = self.subject2identifiers(self.subject)
         else:
@@ -226,10 +370,6 @@ class Subject (Node):
                 contentType = acceptType
                 break
 
-        if contentType == 'text/csv':
-            temporary_file, self.temporary_filename = make_temporary_file('query-result-', self.config['store path'], 'a')
-            temporary_file.close()
-
         def body():
             #self.txlog('TRACE', value='Query::body entered')
             self.http_vary.add('Accept')
@@ -240,40 +380,82 @@ class Subject (Node):
                                           extra_tags=[ ])
 
             #self.txlog('TRACE', value='Query::body query prepared')
-            self.set_http_etag(txid=self.select_predlist_path_txid(path, limit=self.limit))
-            #self.txlog('TRACE', value='Query::body txid computed')
-            cached = self.http_is_cached()
-
-            if cached:
-                web.ctx.status = '304 Not Modified'
-                return None
-            elif contentType == 'application/json':
+            if self.query_explain():
+                self.queryopts['range'] = self.query_range
+                plan = self.explain_files_by_predlist_path(path, limit=self.limit, offset=self.offset, json=(contentType == 'application/json'))
+                self.queryopts['range'] = None
+                return plan
+
+            if contentType == 'text/csv' or response_cache.dirname():
+                # COPY output cannot carry the txid and the response cache is keyed by ETag, so test it separately
+                self.set_http_etag(txid=self.select_predlist_path_txid(path, limit=self.limit))
+                #self.txlog('TRACE', value='Query::body txid computed')
+                if self.http_is_cached():
+                    web.ctx.status = '304 Not Modified'
+                    return None
+                elif self.response_cache_lookup(contentType):
+                    return True
+
+            after = self.keyset_after(path)
+
+            def select_files(json=False):
+                if after == None and self.stream_query_limit(self.limit):
+                    # large results are streamed after commit so need the ETag up front
+                    if self.http_etag is None:
+                        self.set_http_etag(txid=self.select_predlist_path_txid(path, limit=self.limit))
+                        if self.http_is_cached():
+                            return None
+                    return self.stream_files_by_predlist_path(path=path, limit=self.limit, offset=self.offset, json=json)
+                if self.http_etag is not None:
+                    files = self.select_files_by_predlist_path(path=path, limit=self.limit, offset=self.offset, json=json, after=after)
+                else:
+                    files = self.select_files_by_predlist_path_etag(path=path, limit=self.limit, offset=self.offset, json=json, after=after)
+                if files != None and after != None:
+                    files = list(files)
+                    self.keyset_next_page(after, files, self.limit)
+                return files
+
+            if contentType == 'application/json':
                 self.queryopts['range'] = self.query_range
-                files = self.select_files_by_predlist_path(path=path, limit=self.limit, offset=self.offset, json=True)
+                files = select_files(json=True)
                 self.queryopts['range'] = None
+                if files == None:
+                    web.ctx.status = '304 Not Modified'
                 #self.txlog('TRACE', value='Query::body query returned')
                 return files      
             elif contentType == 'text/csv':
                 self.queryopts['range'] = self.query_range
-                temporary_file = open(self.temporary_filename, 'wb')
-                self.copyto_csv_files_by_predlist_path(temporary_file, path, limit=self.limit, offset=self.offset)
+                files = self.stream_csv_files_by_predlist_path(path, limit=self.limit, offset=self.offset, after=after)
                 self.queryopts['range'] = None
-                temporary_file.close()
-                return False
+                return files
             else:
                 self.queryopts['range'] = self.query_range
-                files = [file for file in  self.select_files_by_predlist_path(path=path, limit=self.limit, offset=self.offset) ]
+                files = select_files()
                 self.queryopts['range'] = None
                 #self.txlog('TRACE', value='Query::body query returned')
 
-                return files
+                if files == None:
+                    web.ctx.status = '304 Not Modified'
+                    return None
+                elif isinstance(files, StreamedQuery):
+                    return files
+                return [file for file in files ]
 
         def postCommit(files):
             self.emit_headers()
             if files == None:
                 # caching short cut
                 return
-            
+
+            if isinstance(files, QueryPlan):
+                for buf in self.query_plan_render(files):
+                    yield buf
+                return
+
+            for buf in self.response_cache_render(contentType, render(files)):
+                yield buf
+
+        def render(files):
             #self.log('TRACE', value='Query::body postCommit dispatching on content type')
 
             if contentType == 'text/uri-list':
@@ -281,30 +463,18 @@ class Subject (Node):
                 if self.query_range:
                     raise BadRequest(self, 'Query option "range" not meaningful for text/uri-list result format.')
                 self.header('Content-Type', 'text/uri-list')
+                if isinstance(files, StreamedQuery):
+                    for file in files:
+                        yield "%s/file/%s\n" % (self.config.homepath, self.subject2identifiers(file)[0])
+                    return
                 response = "\n".join([ "%s/file/%s" % (self.config.homepath, self.subject2identifiers(file)[0]) for file in files]) + '\n'
                 self.header('Content-Length', str(len(response)))
                 yield response
                 return
             elif contentType == 'text/csv':
-                try:
-                    f = open(self.temporary_filename, 'rb')
-
-                    try:
-                        f.seek(0, 2)
-                        length = f.tell()
-
-                        self.header('Content-Type', 'text/csv')
-                        self.header('Content-Length', str(length))
-
-                        for buf in yieldBytes(f, 0, length-1, self.config['chunk bytes']):
-                            yield buf
-
-                    finally:
-                        f.close()
-
-                finally:
-                    os.remove(self.temporary_filename)
-
+                self.header('Content-Type', 'text/csv')
+                for buf in files:
+                    yield buf
                 return
             else:
                 self.header('Content-Type', 'application/json')
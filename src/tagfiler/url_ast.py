@@ -19,12 +19,13 @@ import traceback
 import sys
 import web
 import re
-import os
-from dataserv_app import CatalogManager, NotFound, BadRequest, Conflict, Forbidden, urlquote, urlunquote, jsonWriter, jsonReader, predlist_linearize, path_linearize, downcast_value, jsonArrayFileReader, JSONArrayError, make_temporary_file, yieldBytes
+from dataserv_app import CatalogManager, NotFound, BadRequest, Conflict, Forbidden, urlquote, urlunquote, jsonWriter, jsonReader, predlist_linearize, path_linearize, downcast_value, jsonArrayFileReader, JSONArrayError, response_cache, StreamedQuery, QueryPlan, getParamEnv
 from rest_fileio import FileIO
 import subjects
 from subjects import Node
 import datetime
+import itertools
+import copy
 import StringIO
 import psycopg2
 import psycopg2.extensions
@@ -672,25 +673,49 @@ class FileTags (Node):
                                       extra_tags=[ ])
 
         self.http_vary.add('Accept')
-        self.set_http_etag(self.select_predlist_path_txid(self.path_modified))
-        if self.http_is_cached():
-            web.ctx.status = '304 Not Modified'
-            return None, None
-        
-        self.txlog('GET TAGS', dataset=path_linearize(self.path_modified))
 
         all = [ tagdef for tagdef in self.tagdefsdict.values() if tagdef.tagname in self.listtags ]
         all.sort(key=lambda tagdef: tagdef.tagname)
 
-        if self.acceptType == 'application/json':
-            files = self.select_files_by_predlist_path(self.path_modified, limit=self.limit, json=True)
-        elif self.acceptType == 'text/csv':
-            temporary_file = open(self.temporary_filename, 'wb')
-            self.copyto_csv_files_by_predlist_path(temporary_file, self.path_modified, limit=self.limit)
-            temporary_file.close()
-            return (False, all)
+        if self.query_explain():
+            return (self.explain_files_by_predlist_path(self.path_modified, limit=self.limit, json=(self.acceptType == 'application/json')), all)
+
+        if self.acceptType == 'text/csv' or response_cache.dirname():
+            # COPY output cannot carry the txid and the response cache is keyed by ETag, so test it separately
+            self.set_http_etag(self.select_predlist_path_txid(self.path_modified))
+            if self.http_is_cached():
+                web.ctx.status = '304 Not Modified'
+                return None, None
+            elif self.response_cache_lookup(self.acceptType):
+                return (True, all)
+
+        after = self.keyset_after(self.path_modified)
+
+        if self.acceptType == 'text/csv':
+            self.txlog('GET TAGS', dataset=path_linearize(self.path_modified))
+            return (self.stream_csv_files_by_predlist_path(self.path_modified, limit=self.limit, after=after), all)
+
+        if self.acceptType in [ 'application/json', 'text/uri-list' ] and after == None and self.stream_query_limit(self.limit):
+            # large results are streamed after commit so need the ETag up front
+            if self.http_etag is None:
+                self.set_http_etag(self.select_predlist_path_txid(self.path_modified))
+                if self.http_is_cached():
+                    web.ctx.status = '304 Not Modified'
+                    return None, None
+            self.txlog('GET TAGS', dataset=path_linearize(self.path_modified))
+            return (self.stream_files_by_predlist_path(self.path_modified, limit=self.limit, json=(self.acceptType == 'application/json')), all)
+
+        if self.http_etag is not None:
+            files = self.select_files_by_predlist_path(self.path_modified, limit=self.limit, json=(self.acceptType == 'application/json'), after=after)
         else:
-            files = list(self.select_files_by_predlist_path(self.path_modified, limit=self.limit))
+            files = self.select_files_by_predlist_path_etag(self.path_modified, limit=self.limit, json=(self.acceptType == 'application/json'), after=after)
+        if files == None:
+            web.ctx.status = '304 Not Modified'
+            return None, None
+
+        self.txlog('GET TAGS', dataset=path_linearize(self.path_modified))
+        files = list(files)
+        self.keyset_next_page(after, files, self.limit)
 
         if len(files) == 0:
             raise NotFound(self, 'subject matching "%s"' % predlist_linearize(self.path_modified[-1][0], lambda x: x))
@@ -713,8 +738,27 @@ class FileTags (Node):
         if files == None:
             # caching short-cut
             return
+
+        if isinstance(files, QueryPlan):
+            self.emit_headers()
+            for buf in self.query_plan_render(files):
+                yield buf
+            return
+
+        if isinstance(files, StreamedQuery):
+            # fetch the first row before any headers so an empty result can still be reported
+            rows = iter(files)
+            first = next(rows, None)
+            if first == None:
+                raise NotFound(self, 'subject matching "%s"' % predlist_linearize(self.path_modified[-1][0], lambda x: x))
+            files = itertools.chain([ first ], rows)
         
         self.emit_headers()
+
+        for buf in self.response_cache_render(self.acceptType, self.get_render(files, all)):
+            yield buf
+
+    def get_render(self, files, all):
         if self.acceptType == 'text/uri-list':
             def render_file(file):
               subject = self.subject2identifiers(file)[0]
@@ -731,7 +775,11 @@ class FileTags (Node):
               return ''.join([ render_tagvals(tagdef) for tagdef in all or [] ])
             
             self.header('Content-Type', 'text/uri-list')
-            yield ''.join([ render_file(file) for file in files or [] ])
+            if type(files) == list:
+                yield ''.join([ render_file(file) for file in files ])
+            else:
+                for file in files:
+                    yield render_file(file)
         elif self.acceptType == 'application/x-www-form-urlencoded':
             self.header('Content-Type', 'application/x-www-form-urlencoded')
             for file in files:
@@ -747,25 +795,9 @@ class FileTags (Node):
                             body.append(urlquote(tagdef.tagname) + '=' + urlquote(file[tagdef.tagname]))
                 yield '&'.join(body) + '\n'
         elif self.acceptType == 'text/csv':
-            try:
-                f = open(self.temporary_filename, 'rb')
-
-                try:
-                    f.seek(0, 2)
-                    length = f.tell()
-
-                    self.header('Content-Type', 'text/csv')
-                    self.header('Content-Length', str(length))
-
-                    for buf in yieldBytes(f, 0, length-1, self.config['chunk bytes']):
-                        yield buf
-
-                finally:
-                    f.close()
-
-            finally:
-                os.remove(self.temporary_filename)
-
+            self.header('Content-Type', 'text/csv')
+            for buf in files:
+                yield buf
             return
         elif self.acceptType == 'text/plain':
             self.header('Content-Type', 'text/plain')
@@ -801,10 +833,6 @@ class FileTags (Node):
         if self.acceptType == None:
             self.acceptType = 'application/json'
 
-        if self.acceptType == 'text/csv':
-            temporary_file, self.temporary_filename = make_temporary_file('query-result-', self.config['store path'], 'a')
-            temporary_file.close()
-
         if self.acceptType == 'text/plain':
             subjpreds, listpreds, otags = self.path[-1]
             if len(listpreds) != 1:
@@ -916,3 +944,138 @@ class FileTags (Node):
         return self.dbtransact(self.delete_body, self.delete_postCommit)
 
 
+class Query (Node):
+    """Represents QUERY URIs accepting a batch of query paths
+
+       POST   -- runs each query path of a JSON input list in one transaction
+    """
+
+    max_items = 100
+
+    # the batch only reads, so POST is subject to the content read ACL
+    read_methods = [ 'GET', 'HEAD', 'POST' ]
+
+    def __init__(self, parser, appname, catalog_id, queryopts={}):
+        Node.__init__(self, parser, appname, catalog_id, queryopts)
+        self.items = []
+
+    def parse_item(self, item):
+        """Return web.Storage(path, opts, etag) for one batch input item.
+
+           An item is a query path string, or an object with a "path"
+           string, an optional "etag" from a previous response to
+           test, and any of the limit, offset, list, or view query
+           options.
+        """
+        if type(item) in [ str, unicode ]:
+            item = dict(path=item)
+        if type(item) != dict or type(item.get('path')) not in [ str, unicode ]:
+            raise BadRequest(self, 'Each batch query item must be a query path or an object with a "path" field.')
+
+        try:
+            ast = self.url_parse_func(item['path'].encode('utf8'))
+        except:
+            ast = None
+        if not hasattr(ast, 'is_subquery'):
+            raise BadRequest(self, 'Batch query path "%s" not a valid query path.' % item['path'])
+
+        # options take the string forms prepare_path_query() expects from the URL
+        opts = dict()
+        for k in [ 'limit', 'offset' ]:
+            v = item.get(k)
+            if type(v) in [ int, long ] and v >= 0:
+                opts[k] = str(v)
+            elif k == 'limit' and v in [ None, 'none' ] and item.has_key(k):
+                opts[k] = 'none'
+            elif v != None:
+                raise BadRequest(self, 'Batch query item field "%s" must be a non-negative integer.' % k)
+        if item.has_key('list'):
+            v = item['list']
+            if type(v) == list and not [ x for x in v if type(x) not in [ str, unicode ] ]:
+                opts['list'] = v
+            elif type(v) in [ str, unicode ]:
+                opts['list'] = v
+            else:
+                raise BadRequest(self, 'Batch query item field "list" must be a tag name or a list of tag names.')
+        if item.has_key('view'):
+            if type(item['view']) not in [ str, unicode ]:
+                raise BadRequest(self, 'Batch query item field "view" must be a view name.')
+            opts['view'] = item['view']
+        if type(item.get('etag')) not in [ type(None), str, unicode ]:
+            raise BadRequest(self, 'Batch query item field "etag" must be a string.')
+
+        return web.Storage(path=copy.deepcopy(ast.path), opts=opts, etag=item.get('etag'))
+
+    def post_body(self):
+        queryopts = self.queryopts
+        results = []
+        try:
+            for item in self.items:
+                # prepare_path_query() takes per-item options from self.queryopts
+                self.queryopts = item.opts
+                path, listtags, writetags, limit, offset = \
+                      self.prepare_path_query(item.path,
+                                              list_priority=['path', 'list', 'view', 'default', 'all'],
+                                              extra_tags=[ ])
+
+                if item.etag != None:
+                    self.set_http_etag(self.select_predlist_path_txid(path))
+                    if self.http_etag == item.etag:
+                        results.append( (self.http_etag, None) )
+                        continue
+                    files = self.select_files_by_predlist_path(path, limit=limit, offset=offset, json=True)
+                else:
+                    txid, files = self.select_files_by_predlist_path_txid(path, limit=limit, offset=offset, json=True)
+                    self.set_http_etag(txid)
+
+                self.txlog('GET TAGS', dataset=path_linearize(path))
+                results.append( (self.http_etag, list(files)) )
+        finally:
+            self.queryopts = queryopts
+            # each item carries its own ETag, so the response as a whole has none
+            self.http_etag = None
+
+        return results
+
+    def post_postCommit(self, results):
+        self.emit_headers()
+        self.header('Content-Type', 'application/json')
+        yield '['
+        pref = ''
+        for etag, files in results:
+            if files == None:
+                yield pref + '{"etag": %s, "status": 304}\n' % jsonWriter(etag)
+            else:
+                yield pref + '{"etag": %s, "results": [' % jsonWriter(etag)
+                fpref = ''
+                for f in files:
+                    yield fpref + f.json + '\n'
+                    fpref = ','
+                yield ']}\n'
+            pref = ','
+        yield ']\n'
+
+    def POST(self, uri):
+        try:
+            content_type = web.ctx.env['CONTENT_TYPE'].lower()
+        except:
+            content_type = 'text/plain'
+
+        if content_type.split(';')[0] != 'application/json':
+            raise BadRequest(self, 'Content type (%s) not supported.' % content_type)
+
+        try:
+            items = jsonReader(web.data())
+        except ValueError, msg:
+            raise BadRequest(self, 'Invalid json input to POST query: %s' % msg)
+
+        if type(items) != list:
+            raise BadRequest(self, 'Input to POST query must be a JSON array of query items.')
+
+        if len(items) > getParamEnv('batch query items', Query.max_items):
+            raise BadRequest(self, 'Batch of %d query items exceeds limit of %d.' % (len(items), getParamEnv('batch query items', Query.max_items)))
+
+        self.items = [ self.parse_item(item) for item in items ]
+
+        for r in self.client_checked(self.dbtransact(self.post_body, self.post_postCommit)):
+            yield r
@@ -19,14 +19,31 @@ import ply.yacc as yacc
 import threading
 import web
 import urllib
+import copy
+from collections import OrderedDict
 
 from url_lex import make_lexer, tokens, keywords
+from dataserv_app import getParamEnv
 
 # use ast module to build abstract syntax tree
 import url_ast
 
 url_parse_func = None
 
+class NodeTemplate (object):
+    """Parse result for a dispatchable URI, instantiated afresh for each request.
+
+       AST node constructors bind request state, so the parser builds
+       templates of constructor arguments that can be cached and replayed.
+    """
+
+    def __init__(self, cls, **kwargs):
+        self.cls = cls
+        self.kwargs = kwargs
+
+    def instantiate(self):
+        return self.cls(**copy.deepcopy(self.kwargs))
+
 ################################################
 # here's the grammar and ast production rules
 
@@ -39,6 +56,7 @@ def p_start(p):
              | tagdef
              | tags
              | querypathroot
+             | query
              | catalog
              | configure
 """
@@ -56,7 +74,7 @@ def p_querypathroot(p):
 
 def p_maintenance(p):
     """maintenance : slash string slash CATALOG slash NUMSTRING slash MAINTENANCE queryopts"""
-    p[0] = url_ast.Maintenance(parser=url_parse_func, appname=p[2], catalog_id=p[6], queryopts=p[9])
+    p[0] = NodeTemplate(url_ast.Maintenance, parser=url_parse_func, appname=p[2], catalog_id=p[6], queryopts=p[9])
 
 #def p_toplevel_opts1(p):
 #    """toplevel : slash string queryopts"""
@@ -69,88 +87,93 @@ def p_maintenance(p):
 def p_catalogs(p):
     """catalog : slash string slash CATALOG
                | slash string slash CATALOG slash"""
-    p[0] = url_ast.Catalog(parser=url_parse_func, appname=p[2])
+    p[0] = NodeTemplate(url_ast.Catalog, parser=url_parse_func, appname=p[2])
 
 def p_catalogs_id(p):
     """catalog : slash string slash CATALOG slash NUMSTRING
                | slash string slash CATALOG slash NUMSTRING slash"""
-    p[0] = url_ast.Catalog(parser=url_parse_func, appname=p[2], catalog_id=p[6])
+    p[0] = NodeTemplate(url_ast.Catalog, parser=url_parse_func, appname=p[2], catalog_id=p[6])
 
 def p_configure(p):
     """configure : slash string slash CATALOG slash NUMSTRING slash CONFIG
                  | slash string slash CATALOG slash NUMSTRING slash CONFIG slash"""
-    p[0] = url_ast.CatalogConfig(parser=url_parse_func, appname=p[2], catalog_id=p[6])
+    p[0] = NodeTemplate(url_ast.CatalogConfig, parser=url_parse_func, appname=p[2], catalog_id=p[6])
 
 def p_configure_property(p):
     """configure : slash string slash CATALOG slash NUMSTRING slash CONFIG slash STRING
                  | slash string slash CATALOG slash NUMSTRING slash CONFIG slash STRING slash"""
-    p[0] = url_ast.CatalogConfig(parser=url_parse_func, appname=p[2], catalog_id=p[6], prop_name=p[10])
+    p[0] = NodeTemplate(url_ast.CatalogConfig, parser=url_parse_func, appname=p[2], catalog_id=p[6], prop_name=p[10])
 
 def p_configure_property_value(p):
     """configure : slash string slash CATALOG slash NUMSTRING slash CONFIG slash STRING slash STRING
                  | slash string slash CATALOG slash NUMSTRING slash CONFIG slash STRING slash STRING slash"""
-    p[0] = url_ast.CatalogConfig(parser=url_parse_func, appname=p[2], catalog_id=p[6], prop_name=p[10], prop_val=p[12])
+    p[0] = NodeTemplate(url_ast.CatalogConfig, parser=url_parse_func, appname=p[2], catalog_id=p[6], prop_name=p[10], prop_val=p[12])
     
 def p_subject0(p):
     """subject : slash string slash CATALOG slash NUMSTRING slash SUBJECT"""
-    p[0] = url_ast.Subject(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=[])
+    p[0] = NodeTemplate(url_ast.Subject, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=[])
 
 def p_subject1(p):
     """subject : slash string slash CATALOG slash NUMSTRING slash SUBJECT slash querypath"""
-    p[0] = url_ast.Subject(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10])
+    p[0] = NodeTemplate(url_ast.Subject, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10])
 
 def p_subject1_opts(p):
     """subject : slash string slash CATALOG slash NUMSTRING slash SUBJECT slash querypath queryopts"""
-    p[0] = url_ast.Subject(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10], queryopts=p[11])
+    p[0] = NodeTemplate(url_ast.Subject, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10], queryopts=p[11])
 
 def p_subject_opts(p):
     """subject : slash string slash CATALOG slash NUMSTRING slash SUBJECT queryopts"""
-    p[0] = url_ast.Subject(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=[], queryopts=p[9])
+    p[0] = NodeTemplate(url_ast.Subject, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=[], queryopts=p[9])
+
+def p_query(p):
+    """query : slash string slash CATALOG slash NUMSTRING slash QUERY
+             | slash string slash CATALOG slash NUMSTRING slash QUERY slash"""
+    p[0] = NodeTemplate(url_ast.Query, parser=url_parse_func, appname=p[2], catalog_id=p[6])
 
 def p_file(p):
     """file : slash string slash CATALOG slash NUMSTRING slash FILE slash querypath"""
-    p[0] = url_ast.FileId(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10])
+    p[0] = NodeTemplate(url_ast.FileId, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10])
 
 def p_file_opts(p):
     """file : slash string slash CATALOG slash NUMSTRING slash FILE slash querypath queryopts"""
-    p[0] = url_ast.FileId(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10], queryopts=p[11])
+    p[0] = NodeTemplate(url_ast.FileId, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10], queryopts=p[11])
 
 def p_tagdef(p):
     """tagdef : slash string slash CATALOG slash NUMSTRING slash TAGDEF
               | slash string slash CATALOG slash NUMSTRING slash TAGDEF slash"""
     # GET all definitions and a creation form (HTML)
-    p[0] = url_ast.Tagdef(parser=url_parse_func, appname=p[2], catalog_id=p[6])
+    p[0] = NodeTemplate(url_ast.Tagdef, parser=url_parse_func, appname=p[2], catalog_id=p[6])
 
 def p_tagdef_rest_get(p):
     """tagdef : slash string slash CATALOG slash NUMSTRING slash TAGDEF slash string"""
     # GET a single definition (URL encoded)
-    p[0] = url_ast.Tagdef(parser=url_parse_func, appname=p[2], catalog_id=p[6], tag_id=p[10])
+    p[0] = NodeTemplate(url_ast.Tagdef, parser=url_parse_func, appname=p[2], catalog_id=p[6], tag_id=p[10])
 
 def p_tagdef_rest_put(p):
     """tagdef : slash string slash CATALOG slash NUMSTRING slash TAGDEF slash string queryopts"""
     # PUT queryopts supports dbtype=string&multivalue=boolean&readpolicy=pol&writepolicy=pol
-    p[0] = url_ast.Tagdef(parser=url_parse_func, appname=p[2], catalog_id=p[6], tag_id=p[10], queryopts=p[11])
+    p[0] = NodeTemplate(url_ast.Tagdef, parser=url_parse_func, appname=p[2], catalog_id=p[6], tag_id=p[10], queryopts=p[11])
 
 def p_tags_all(p):
     """tags : slash string slash CATALOG slash NUMSTRING slash TAGS
             | slash string slash CATALOG slash NUMSTRING slash TAGS slash"""
-    p[0] = url_ast.FileTags(parser=url_parse_func, appname=p[2], catalog_id=p[6])
+    p[0] = NodeTemplate(url_ast.FileTags, parser=url_parse_func, appname=p[2], catalog_id=p[6])
 
 def p_tags_all_opts(p):
     """tags : slash string slash CATALOG slash NUMSTRING slash TAGS queryopts"""
-    p[0] = url_ast.FileTags(parser=url_parse_func, appname=p[2], catalog_id=p[6], queryopts=p[9])
+    p[0] = NodeTemplate(url_ast.FileTags, parser=url_parse_func, appname=p[2], catalog_id=p[6], queryopts=p[9])
 
 def p_tags_all_slash_opts(p):
     """tags : slash string slash CATALOG slash NUMSTRING slash TAGS slash queryopts"""
-    p[0] = url_ast.FileTags(parser=url_parse_func, appname=p[2], catalog_id=p[6], queryopts=p[10])
+    p[0] = NodeTemplate(url_ast.FileTags, parser=url_parse_func, appname=p[2], catalog_id=p[6], queryopts=p[10])
 
 def p_tags(p):
     """tags : slash string slash CATALOG slash NUMSTRING slash TAGS slash querypath"""
-    p[0] = url_ast.FileTags(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10])
+    p[0] = NodeTemplate(url_ast.FileTags, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10])
 
 def p_tags_opts(p):
     """tags : slash string slash CATALOG slash NUMSTRING slash TAGS slash querypath queryopts"""
-    p[0] = url_ast.FileTags(parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10], queryopts=p[11])
+    p[0] = NodeTemplate(url_ast.FileTags, parser=url_parse_func, appname=p[2], catalog_id=p[6], path=p[10], queryopts=p[11])
 
 def p_querypath_elem_general(p):
     """querypath_elem : predlist '(' predlist ')' ordertags"""
@@ -400,23 +423,61 @@ def make_parser():
     return yacc.yacc(debug=False, optimize=1, tabmodule='urlparsetab', write_tables=1)
 #    return yacc.yacc()
 
+class ParseCache (object):
+    """A bounded LRU of parse results keyed by the raw URI or subquery string."""
+
+    max_entries = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, s):
+        self.lock.acquire()
+        try:
+            result = self.entries.pop(s, None)
+            if result != None:
+                # reinsert as most recently used
+                self.entries[s] = result
+            return result
+        finally:
+            self.lock.release()
+
+    def put(self, s, result):
+        self.lock.acquire()
+        try:
+            self.entries[s] = result
+            while len(self.entries) > getParamEnv('parse cache entries', ParseCache.max_entries):
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
 def make_parse():
+    # table generation is not thread-safe, but parsing with separate instances is
     lock = threading.Lock()
-    lock.acquire()
-    try:
-        parser = make_parser()
-        lexer = make_lexer()
-    finally:
-        lock.release()
-        
+    local = threading.local()
+    cache = ParseCache()
+
     def parse(s):
-        lock.acquire()
-        try:
-            return parser.parse(s, lexer=lexer)
-        finally:
-            lock.release()
+        result = cache.get(s)
+        if result == None:
+            if not hasattr(local, 'parser'):
+                lock.acquire()
+                try:
+                    local.parser = make_parser()
+                    local.lexer = make_lexer()
+                finally:
+                    lock.release()
+            result = local.parser.parse(s, lexer=local.lexer)
+            cache.put(s, result)
+
+        if isinstance(result, NodeTemplate):
+            return result.instantiate()
+        else:
+            # return a private copy of cached data such as Subquery
+            return copy.deepcopy(result)
     return parse
 
-# provide a mutexed parser instance for all to use
+# provide a parser function with per-thread parser instances for all to use
 url_parse_func = make_parse()
 